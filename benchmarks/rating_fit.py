@@ -0,0 +1,51 @@
+import argparse
+import logging
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import rating
+
+"""rating_fit.py: Microbenchmark of the robust round rating fit (rating.fit_round)."""
+
+
+def synthetic_round(players: int, seed: int):
+    """Propagator ratings and scores of a par 54 round."""
+    rng = np.random.default_rng(seed)
+    ratings = rng.integers(700, 1050, players)
+    noise = np.where(rng.random(players) < 0.8, rng.normal(0, 3, players), rng.normal(0, 9, players))
+    scores = np.rint(54 + (950 - ratings) / 9 + noise).astype(np.int64)
+    return ratings, scores
+
+
+def linregress_fit(ratings: np.ndarray, scores: np.ndarray):
+    """The first fit done with scipy.stats.linregress, for comparison."""
+    from scipy import stats
+    lr = stats.linregress(ratings, scores)
+    return lr.slope, lr.intercept, lr.rvalue
+
+
+if __name__ == '__main__':
+    argparser = argparse.ArgumentParser()
+    argparser.add_argument('--players', type=int, nargs='+', default=[20, 60, 150, 500])
+    argparser.add_argument('--number', type=int, default=200)
+    args = argparser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    for players in args.players:
+        ratings, scores = synthetic_round(players, seed=players)
+        fit = timeit.timeit(lambda: rating.fit_round('bench', 0, 54, ratings, scores, players, 0.25),
+                            number=args.number) / args.number
+        line = f"{players:5d} propagators: fit_round {fit * 1e6:8.1f} us"
+        first = timeit.timeit(lambda: rating.linear_fit(ratings, scores), number=args.number) / args.number
+        line += f", linear_fit {first * 1e6:6.1f} us"
+        try:
+            linregress_fit(ratings, scores)  # imports scipy
+            reference = timeit.timeit(lambda: linregress_fit(ratings, scores), number=args.number) / args.number
+            line += f", scipy.stats.linregress {reference * 1e6:6.1f} us"
+        except ImportError:
+            pass
+        print(line)
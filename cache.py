@@ -0,0 +1,357 @@
+import json
+from abc import ABC, abstractmethod
+import logging
+import os.path
+import pickle
+import sqlite3
+from collections.abc import MutableMapping
+from typing import Dict, Iterable, Iterator, List
+
+from models import Player
+
+"""cache.py: Storage backends for the MetrixAPI cache (results, players, ratings and playoffs)."""
+
+__author__ = "Jakub Wroniecki"
+__copyright__ = "Copyright 2022, Jakub Wroniecki, see LICENSE.txt for details."
+
+
+SQLITE_EXTENSIONS = ('.sqlite', '.sqlite3', '.db')
+SECTIONS = ('competitions', 'fetch_info', 'players', 'ratings', 'ratings_info', 'playoffs')
+
+
+def empty_cache() -> dict:
+    return {
+        'competitions': {},
+        'fetch_info': {},
+        'players': [],
+        'ratings': {},
+        'ratings_info': {},
+        'playoffs': {},
+    }
+
+
+def empty_changes() -> Dict[str, set]:
+    """Keys changed since the last save: competition IDs, or Player objects for the 'players' section."""
+    return {section: set() for section in SECTIONS}
+
+
+class CacheBackend(ABC):
+    """Loads and stores the cache dictionary used by MetrixAPI.
+
+    Sections 'competitions', 'fetch_info', 'ratings', 'ratings_info' and 'playoffs' are mappings keyed by
+    competition ID, 'players' is a list of Player objects.
+    """
+
+    @abstractmethod
+    def load(self) -> dict:
+        pass
+
+    @abstractmethod
+    def save(self, cache: dict):
+        pass
+
+    @abstractmethod
+    def save_changes(self, cache: dict, changes: Dict[str, set]):
+        """Store only the records listed in `changes` (see `empty_changes`). Keys missing from the cache are
+        deleted."""
+
+
+class PickleCacheBackend(CacheBackend):
+    """Whole cache pickled into one file, with changes appended to a journal file next to it.
+
+    The journal is replayed on load and compacted into the main file once it holds `compact_after` records.
+    """
+
+    def __init__(self, filename: str, compact_after=1000):
+        self.filename = filename
+        self.journal_filename = f'{filename}.journal'
+        self.compact_after = compact_after
+        self._journal_records = 0
+
+    def load(self) -> dict:
+        cache = empty_cache()
+        if os.path.isfile(self.filename):
+            with open(self.filename, 'rb') as f:
+                cache.update(pickle.load(f))
+        self._journal_records = 0
+        if os.path.isfile(self.journal_filename):
+            self.replay_journal(cache)
+        return cache
+
+    def replay_journal(self, cache: dict):
+        players = {p.id: idx for idx, p in enumerate(cache['players'])}
+        with open(self.journal_filename, 'rb') as f:
+            while True:
+                try:
+                    section, key, value = pickle.load(f)
+                except EOFError:
+                    break
+                except pickle.UnpicklingError:
+                    logging.warning(f"Truncated cache journal {self.journal_filename} - ignoring the last record.")
+                    break
+                self._journal_records += 1
+                if section == 'players':
+                    if key in players:
+                        cache['players'][players[key]] = value
+                    else:
+                        players[key] = len(cache['players'])
+                        cache['players'].append(value)
+                elif value is None:
+                    cache[section].pop(key, None)
+                else:
+                    cache[section][key] = value
+
+    def save(self, cache: dict):
+        with open(f'{self.filename}.tmp', 'wb') as f:
+            pickle.dump(cache, f)
+        os.replace(f'{self.filename}.tmp', self.filename)
+        if os.path.isfile(self.journal_filename):
+            os.remove(self.journal_filename)
+        self._journal_records = 0
+
+    def save_changes(self, cache: dict, changes: Dict[str, set]):
+        if not os.path.isfile(self.filename) or self._journal_records >= self.compact_after:
+            self.save(cache)
+            return
+
+        with open(self.journal_filename, 'ab') as f:
+            for section, keys in changes.items():
+                for key in keys:
+                    if section == 'players':
+                        record = (section, key.id, key)
+                    else:
+                        record = (section, key, cache[section].get(key))
+                    pickle.dump(record, f)
+                    self._journal_records += 1
+
+
+class SqliteMapping(MutableMapping):
+    """Mapping of competition ID -> value, loaded lazily from a SQLite table.
+
+    Values read or assigned are kept in memory; `flush()` writes them back. When `write_loaded` is False only
+    assigned values are written (used for immutable values, like raw API replies).
+    """
+
+    def __init__(self, backend: 'SqliteCacheBackend', section: str, write_loaded=True):
+        self._backend = backend
+        self._section = section
+        self._write_loaded = write_loaded
+        self._values = {}
+        self._changed = set()
+        self._deleted = set()
+
+    def __getitem__(self, key):
+        if key not in self._values:
+            if key in self._deleted:
+                raise KeyError(key)
+            value = self._backend.read(self._section, key)
+            if value is None:
+                raise KeyError(key)
+            self._values[key] = value
+        return self._values[key]
+
+    def __setitem__(self, key, value):
+        self._values[key] = value
+        self._changed.add(key)
+        self._deleted.discard(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._values.pop(key, None)
+        self._changed.discard(key)
+        self._deleted.add(key)
+
+    def __contains__(self, key):
+        if key in self._values:
+            return True
+        if key in self._deleted:
+            return False
+        return self._backend.contains(self._section, key)
+
+    def __iter__(self) -> Iterator[int]:
+        keys = dict.fromkeys(self._backend.keys(self._section))
+        keys.update(dict.fromkeys(self._values))
+        return iter([k for k in keys if k not in self._deleted])
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def flush(self):
+        written = self._values.keys() if self._write_loaded else self._changed
+        for key in self._deleted:
+            self._backend.delete(self._section, key)
+        for key in written:
+            self._backend.write(self._section, key, self._values[key])
+        self._changed.clear()
+        self._deleted.clear()
+
+
+class SqliteCacheBackend(CacheBackend):
+    """Cache stored in a SQLite database - one row per competition, player and round rating.
+
+    Competitions, ratings and playoffs are read on first access, so loading the cache costs only the players table.
+    """
+
+    # sections stored as one row of named columns per competition
+    RECORD_COLUMNS = {
+        'fetch_info': ('etag', 'last_modified', 'fetched_at'),
+        'ratings_info': ('rating_par', 'rating_propagators', 'rating_per_stroke', 'rating_fingerprint'),
+    }
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS competitions (
+            id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS fetch_info (
+            competition_id INTEGER PRIMARY KEY,
+            etag TEXT,
+            last_modified TEXT,
+            fetched_at REAL
+        );
+        CREATE TABLE IF NOT EXISTS players (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            pdga_id INTEGER,
+            pdga_rating INTEGER,
+            default_category TEXT
+        );
+        CREATE TABLE IF NOT EXISTS ratings (
+            competition_id INTEGER NOT NULL,
+            player_id INTEGER NOT NULL,
+            rating INTEGER,
+            PRIMARY KEY (competition_id, player_id)
+        );
+        CREATE TABLE IF NOT EXISTS ratings_info (
+            competition_id INTEGER PRIMARY KEY,
+            rating_par INTEGER,
+            rating_propagators INTEGER,
+            rating_per_stroke REAL,
+            rating_fingerprint TEXT
+        );
+        CREATE TABLE IF NOT EXISTS playoffs (
+            competition_id INTEGER NOT NULL,
+            player_id INTEGER NOT NULL,
+            playoff_result INTEGER NOT NULL,
+            PRIMARY KEY (competition_id, player_id)
+        );
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        self.db.executescript(self.SCHEMA)
+        self.upgrade_schema()
+
+    def upgrade_schema(self):
+        # columns added to record sections after their table was created
+        for section, columns in self.RECORD_COLUMNS.items():
+            existing = {row[1] for row in self.db.execute(f"PRAGMA table_info({section})")}
+            for column in columns:
+                if column not in existing:
+                    self.db.execute(f"ALTER TABLE {section} ADD COLUMN {column}")
+
+    def load(self) -> dict:
+        return {
+            'competitions': SqliteMapping(self, 'competitions', write_loaded=False),
+            'fetch_info': SqliteMapping(self, 'fetch_info', write_loaded=False),
+            'players': [Player(id=row[0], name=row[1], pdga_id=row[2], pdga_rating=row[3], default_category=row[4])
+                        for row in self.db.execute("SELECT id, name, pdga_id, pdga_rating, default_category "
+                                                   "FROM players ORDER BY name")],
+            'ratings': SqliteMapping(self, 'ratings'),
+            'ratings_info': SqliteMapping(self, 'ratings_info'),
+            'playoffs': SqliteMapping(self, 'playoffs'),
+        }
+
+    def save(self, cache: dict):
+        with self.db:
+            self.save_players(cache['players'])
+            for section in ('competitions', 'fetch_info', 'ratings', 'ratings_info', 'playoffs'):
+                values = cache[section]
+                if isinstance(values, SqliteMapping) and values._backend is self:
+                    values.flush()
+                else:
+                    # section replaced by a plain dict (e.g. cleared in the editor)
+                    self.db.execute(f"DELETE FROM {section}")
+                    for key, value in values.items():
+                        self.write(section, key, value)
+
+    def save_changes(self, cache: dict, changes: Dict[str, set]):
+        with self.db:
+            self.save_players(changes['players'])
+            for section, keys in changes.items():
+                if section == 'players':
+                    continue
+                values = cache[section]
+                for key in keys:
+                    if key in values:
+                        self.write(section, key, values[key])
+                    else:
+                        self.delete(section, key)
+                if isinstance(values, SqliteMapping):
+                    values._changed.difference_update(keys)
+                    values._deleted.difference_update(keys)
+
+    def save_players(self, players: Iterable[Player]):
+        self.db.executemany("INSERT OR REPLACE INTO players (id, name, pdga_id, pdga_rating, default_category) "
+                            "VALUES (?, ?, ?, ?, ?)",
+                            [(p.id, p.name, p.pdga_id, p.pdga_rating, p.default_category) for p in players])
+
+    def contains(self, section: str, key: int) -> bool:
+        column = 'id' if section == 'competitions' else 'competition_id'
+        return self.db.execute(f"SELECT 1 FROM {section} WHERE {column} = ? LIMIT 1", (key,)).fetchone() is not None
+
+    def keys(self, section: str) -> List[int]:
+        column = 'id' if section == 'competitions' else 'competition_id'
+        return [row[0] for row in self.db.execute(f"SELECT DISTINCT {column} FROM {section}")]
+
+    def read(self, section: str, key: int):
+        if section == 'competitions':
+            row = self.db.execute("SELECT data FROM competitions WHERE id = ?", (key,)).fetchone()
+            return json.loads(row[0]) if row is not None else None
+        elif section in self.RECORD_COLUMNS:
+            columns = self.RECORD_COLUMNS[section]
+            row = self.db.execute(f"SELECT {', '.join(columns)} FROM {section} WHERE competition_id = ?",
+                                  (key,)).fetchone()
+            return dict(zip(columns, row)) if row is not None else None
+        else:
+            value_column = 'rating' if section == 'ratings' else 'playoff_result'
+            rows = self.db.execute(f"SELECT player_id, {value_column} FROM {section} WHERE competition_id = ?",
+                                   (key,)).fetchall()
+            return {player_id: value for player_id, value in rows} if len(rows) > 0 else None
+
+    def write(self, section: str, key: int, value):
+        if section == 'competitions':
+            self.db.execute("INSERT OR REPLACE INTO competitions (id, data) VALUES (?, ?)", (key, json.dumps(value)))
+        elif section in self.RECORD_COLUMNS:
+            columns = self.RECORD_COLUMNS[section]
+            self.db.execute(f"INSERT OR REPLACE INTO {section} (competition_id, {', '.join(columns)}) "
+                            f"VALUES (?{', ?' * len(columns)})", (key, *(value.get(c) for c in columns)))
+        else:
+            value_column = 'rating' if section == 'ratings' else 'playoff_result'
+            self.delete(section, key)
+            self.db.executemany(f"INSERT INTO {section} (competition_id, player_id, {value_column}) VALUES (?, ?, ?)",
+                                [(key, player_id, v) for player_id, v in value.items()])
+
+    def delete(self, section: str, key: int):
+        column = 'id' if section == 'competitions' else 'competition_id'
+        self.db.execute(f"DELETE FROM {section} WHERE {column} = ?", (key,))
+
+
+def open_cache(filename: str) -> CacheBackend:
+    if os.path.splitext(filename)[1].lower() in SQLITE_EXTENSIONS:
+        return SqliteCacheBackend(filename)
+    return PickleCacheBackend(filename)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    argparser = argparse.ArgumentParser(description="Copy the cache between backends (e.g. pickle -> SQLite).")
+    argparser.add_argument('source', type=str)
+    argparser.add_argument('destination', type=str)
+    args = argparser.parse_args()
+
+    data = open_cache(args.source).load()
+    open_cache(args.destination).save({k: dict(v) if isinstance(v, MutableMapping) else v for k, v in data.items()})
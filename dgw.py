@@ -2,10 +2,14 @@ from dataclasses import dataclass, field
 from typing import Dict, List, Optional
 import logging
 
-from models import RankingEntry, Competition, Player
+from models import RankingEntry, RankingList, Competition, Player
 from metrix import MetrixAPI
-import jinja2
+from utils import rank, select_best
+import numpy as np
+import gzip
+import json
 import os, os.path
+import shutil
 
 DEF_CATS= {"OPEN", "WOMEN", "MASTERS", "JUNIOR"}
 SCORING= {"dgpt100" : [100,85,75,69,64,60,57,54,52,50,48,46,44,42,40,38,36,34,32,30,29,28,27,26,25,24,23,22,21,20,19,18,17,16,15,14,13,12,11,10,9,8,7,6,5,4,3,2,2,2]}
@@ -16,9 +20,86 @@ __author__ = "Jakub Wroniecki"
 __copyright__ = "Copyright 2022, Jakub Wroniecki, see LICENSE.txt for details."
 
 
+DNF_COMMENT = "DNF = 1 pkt"
+DNS_COMMENT = "DNS = 0 pkt"
+
+
 def polish_rounding(num):
     return (int(num*2)+1)//2
 
+
+def proportional_points(places: np.ndarray, dqf: np.ndarray, open_places: np.ndarray = None, open_count=0):
+    """Points for a whole class in proportional scoring: (Lu - place + 1) * (100 / Lu), rounded like polish_rounding.
+
+    Classes with less than 3 players are scored by their place in OPEN (`open_places`) among `open_count` + 1
+    players, with at least 1 point. DNF gets 1 point.
+    """
+    count = len(places)
+    if count >= 3:
+        points = (count - places + 1) * (100 / count)
+    else:
+        points = np.maximum((open_count + 1 - open_places + 1) * (100 / (open_count + 1)), 1)
+    return np.where(dqf, 1, (np.floor(points * 2).astype(np.int64) + 1) // 2)
+
+
+def fixed_points(places: np.ndarray, dqf: np.ndarray, dns: np.ndarray, table: List[int]):
+    """Points for a whole class from a fixed table (e.g. dgpt100). Places past the table get 1 point,
+    DNF 1 point, DNS 0 points."""
+    table = np.asarray(table, dtype=np.int64)
+    points = np.where(places < len(table), table[np.minimum(places, len(table)) - 1], 1)
+    return np.where(dqf, np.where(dns, 0, 1), points)
+
+
+_environment: Optional['jinja2.Environment'] = None
+
+
+def template_environment() -> 'jinja2.Environment':
+    """Environment shared by all renders, compiled templates are also cached on disk (in the temp directory)."""
+    global _environment
+    if _environment is None:
+        import jinja2
+        _environment = jinja2.Environment(loader=jinja2.FileSystemLoader(os.path.dirname(os.path.realpath(__file__))),
+                                          trim_blocks=True, lstrip_blocks=True,
+                                          bytecode_cache=jinja2.FileSystemBytecodeCache())
+    return _environment
+
+
+def write_template(template_name: str, filename: str, **context):
+    """Render the template into `filename` chunk by chunk, without building the whole document in memory."""
+    template = template_environment().get_template(template_name)
+    with open(f'{filename}.tmp', 'w', encoding='utf-8', buffering=1 << 16) as f:
+        f.writelines(template.generate(**context))
+    os.replace(f'{filename}.tmp', filename)
+
+
+def write_json(data, filename: str):
+    with open(f'{filename}.tmp', 'w', encoding='utf-8', buffering=1 << 16) as f:
+        json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(f'{filename}.tmp', filename)
+
+
+class LazyComment:
+    """Points comment, formatted only when rendered."""
+    __slots__ = ('fmt', 'args')
+
+    def __init__(self, fmt: str, *args):
+        self.fmt = fmt
+        self.args = args
+
+    def __str__(self):
+        return self.fmt.format(*self.args)
+
+class RoundsView:
+    """Results of all rounds of the season ordered by rating - built once after the ratings are calculated and
+    shared by the renderers."""
+
+    def __init__(self, competitions: List[Competition], top_count: Optional[int] = 50):
+        rounds = [s for c in competitions for s in (c.sub if c.sub != [] else [c])]
+        self.results = [r for s in rounds for r in s.results]
+        self.top = select_best(self.results, top_count, key=lambda r: -(r.rating or 0))
+        self.by_round = {s.id: sorted(s.results, key=lambda r: r.rating_or_zero, reverse=True) for s in rounds}
+
+
 class ZimowyDGW:
 
     @dataclass
@@ -31,7 +112,7 @@ class ZimowyDGW:
         def best(self, count):
             for s in self.results.values():
                 s.selected = False
-            selected = sorted(self.results.values(), key=lambda r: 1 if r.dqf else -r.points)[:count]
+            selected = select_best(self.results.values(), count, key=lambda r: 1 if r.dqf else -r.points)
             for s in selected:
                 s.selected = True
             self.sum = 0
@@ -47,7 +128,8 @@ class ZimowyDGW:
             return hash(self.player)
 
     def __init__(self, competition_ids: List[int], title='', categories=None, api: Optional[MetrixAPI] = None, scoring="proportional",cache_file=None,ignore_holes=None, 
-                 default_categories=None, use_default_categories=False, scoring_tables=None):
+                 default_categories=None, use_default_categories=False, scoring_tables=None, best_of=7,
+                 top_rounds=50):
         self.competition_ids = competition_ids
         
         self.entries = {}
@@ -65,9 +147,13 @@ class ZimowyDGW:
                 self.entries[cat]={}
                 self.rankings[cat]={}
         
+        self._empty_rankings = dict(self.rankings)
         self.entries_sorted: Dict[str, List[ZimowyDGW.DGWEntry]] = {}
 
         self.scoring=scoring
+        self.best_of = best_of # number of best results counted for the season
+        self.top_rounds_count = top_rounds
+        self.rounds_view: Optional[RoundsView] = None
         self.open_cat=list(categories.keys())[0]
         
         self.competitions: List[Competition] = []
@@ -81,188 +167,258 @@ class ZimowyDGW:
 
         self.ignore_holes=ignore_holes
 
-    def reload(self) -> List[Competition]:
+    @property
+    def ratings(self) -> Dict[int, Dict[int, int]]:
+        """Round ratings: competition ID -> player ID -> rating."""
+        return self.api.cache['ratings'] if self.api is not None else self._ratings
+
+    def __getstate__(self):
+        # pickled for rendering in another process - without the API (HTTP session, cache backend), but with
+        # ratings of the rounds in the standings
+        state = dict(self.__dict__)
+        state['api'] = None
+        state['_ratings'] = {c.id: dict(self.ratings[c.id]) for comp in self.competitions for c in [comp, *comp.sub]
+                             if c.id in self.ratings}
+        return state
+
+    def reload(self, refresh=False) -> List[Competition]:
         api = self.api
         data: List[Competition] = []
 
+        api.prefetch(self.competition_ids, refresh=refresh)
         for competition_id in self.competition_ids:
             if self.ignore_holes and competition_id in self.ignore_holes:
                 data.append(api.results(competition_id,self.ignore_holes[competition_id]))
             else:
                 data.append(api.results(competition_id))
-        
+
+        self.update_standings(data)
+        return data
+
+    def update_standings(self, data: List[Competition]):
+        """Score `data` and build the season standings from scratch.
+
+        Every competition is rescored: ranking entries are shared by all leagues on the same MetrixAPI and rankings
+        of classes missing from a competition are carried over from an earlier one, so points left by a previous
+        call (or by another league) cannot be reused.
+        """
+        self.competitions = list(data)
+        self.rankings = dict(self._empty_rankings)
+        self.entries = {class_name: {} for class_name in self.entries}
+        self.rounds_view = None
+
         for competition in data:
             competition.use_default_category = self.use_default_categories
-            self.competitions.append(competition)            
-
-            for class_name, ranking in competition.ranking:
-                class_name = class_name.upper()
-                real_class_name = class_name    
-
-                if class_name not in self.rankings:
-                    print("Class not in rankings",class_name,self.rankings.keys())
-                    if "MASTER" in class_name:
-                        real_class_name = "MASTERS"
-                    elif "WOMEN" in class_name:
-                        real_class_name = "WOMEN"
-                    elif "JUNIOR" in class_name:
-                        real_class_name = "JUNIOR"
-                    else:
-                        real_class_name = "OPEN"
-                else: #class_name in rankings
-                    real_class_name = class_name
-                    
-                self.rankings[real_class_name] = ranking
-
-            #print("self.rankings.keys", list(self.rankings.keys()),"self.open_cat",self.open_cat,SCORING[self.scoring])
-
-            #if self.open_cat not in self.rankings:
-            #    continue
+            self.update_rankings(competition)
+            for class_name, scored in self.score_competition().items():
+                class_entries = self.entries[class_name]
+                for player, entry in scored.items():
+                    dgw_entry = class_entries.get(player)
+                    if dgw_entry is None:
+                        dgw_entry = class_entries[player] = self.DGWEntry(player=player)
+                    dgw_entry.results[competition.id] = entry
 
-            if self.scoring=="proportional":
-                #LuOpen = len(list(e for e in rankings["OPEN"].entries if not e[1].dqf)) # moglibyśmy nie liczyć DNFów
-                LuOpen = len(list(e for e in self.rankings[self.open_cat].entries)) #  liczymy DNFy do liczby graczy
-
-
-                for class_name, ranking in self.rankings.items():
-                    Lu = len(list(e for e in ranking.entries))# if not e[1].dqf)) # liczymy DNF do LU
-                    if Lu < 3:
-                        filler_ranking = self.rankings[self.open_cat].entries[:]
-                        filler_ranking.extend(ranking.entries)
-
-                    for entry in ranking.entries:
-                        dgw_entry: ZimowyDGW.DGWEntry = self.entries[class_name].get(entry[1].player, self.DGWEntry(player=entry[1].player))
-                        if entry[1].dqf:
-                            entry[1].points = 1
-                            entry[1].comment = "DNF = 1 pkt"
-                        elif Lu >= 3:
-                            points = polish_rounding((Lu-entry[0]+1)*(100/Lu))
-                            entry[1].points = points
-                            entry[1].comment = f"{entry[0]} na {Lu} = ({Lu}-{entry[0]}+1)*(100/{Lu}) = ({Lu - entry[0] +1}*{(100/Lu):0.3f})"
-                        else:
-                            M = 1
-                            for m, re in self.rankings[self.open_cat].entries:
-                                if re.sum < entry[1].sum:
-                                    M = M + 1
-                                else:
-                                    break
-                            entry[1].comment = f"(OPEN) {M} na {LuOpen+1} = ({LuOpen + 1}-{entry[0]}+1)*(100/{Lu}) = ({LuOpen + 1 - entry[0]+1}*{(100/(LuOpen+1)):0.2f}) "
-                            entry[1].points =polish_rounding( max((LuOpen + 1 - M + 1)*(100/(LuOpen+1)),1))
-                        dgw_entry.results[competition.id] = entry[1]
-                        self.entries[class_name][entry[1].player] = dgw_entry
-                        
-            else: # we'll search for scoring table in scoring
-                score_table=self.scoring_tables[self.scoring]['points']
-                for class_name, ranking in self.rankings.items():
-                    if ranking is None: continue
-                    for entry in ranking.entries:
-                        dgw_entry: ZimowyDGW.DGWEntry = self.entries[class_name].get(entry[1].player, self.DGWEntry(player=entry[1].player))
-                        if entry[1].dqf:
-                            if entry[1].dns:
-                                print("DNS",entry[1].player)
-                                entry[1].points = 0
-                                entry[1].comment = "DNS = 0 pkt"
-                                
-                            else: #not DNS, DNF
-                                entry[1].points = 1
-                                entry[1].comment = "DNF = 1 pkt"
-                        else:
-                            if entry[0]<len(score_table):
-                                points = score_table[entry[0]-1]
-                            else: #outside of defined range
-                                points=1
-                                print("outside table")
-                                
-                            entry[1].points = points
-                            entry[1].comment = f" miejsce {entry[0]} {"po dogrywce " if entry[1].sum_tuple[1]>0 else ""}"
-                        dgw_entry.results[competition.id] = entry[1]
-                        self.entries[class_name][entry[1].player] = dgw_entry
-                            
         for class_name, entries in self.entries.items():
             logging.info(f"Generating ranking: {class_name}")
-            self.entries_sorted[class_name] = list(sorted(entries.values(), key=lambda e: -e.best(7)))
-            place = 0
-            count = 1
-            previous_points = 1e24
-            for e in self.entries_sorted[class_name]:
-                if e.sum < previous_points:
-                    place = count
-                    previous_points = e.sum
+            class_entries = list(entries.values())
+            for e in class_entries:
+                e.best(self.best_of)
+            order, places = rank([-e.sum for e in class_entries])
+            self.entries_sorted[class_name] = [class_entries[idx] for idx in order.tolist()]
+            for e, place in zip(self.entries_sorted[class_name], places.tolist()):
                 e.place = place
-                count = count + 1
 
-        return data
+    def update_rankings(self, competition: Competition):
+        for class_name, ranking in competition.ranking:
+            class_name = class_name.upper()
+            real_class_name = class_name
+
+            if class_name not in self.rankings:
+                print("Class not in rankings",class_name,self.rankings.keys())
+                if "MASTER" in class_name:
+                    real_class_name = "MASTERS"
+                elif "WOMEN" in class_name:
+                    real_class_name = "WOMEN"
+                elif "JUNIOR" in class_name:
+                    real_class_name = "JUNIOR"
+                else:
+                    real_class_name = "OPEN"
+            else: #class_name in rankings
+                real_class_name = class_name
+
+            self.rankings[real_class_name] = ranking
+
+    def score_competition(self) -> Dict[str, Dict[Player, RankingEntry]]:
+        """Set points of the current rankings (the last competition passed to `update_rankings`), returns scored
+        entries by class and player."""
+        if self.scoring=="proportional":
+            #LuOpen = len(list(e for e in rankings["OPEN"].entries if not e[1].dqf)) # moglibyśmy nie liczyć DNFów
+            LuOpen = len(list(e for e in self.rankings[self.open_cat].entries)) #  liczymy DNFy do liczby graczy
+            # running max of OPEN sums in ranking order: the place in OPEN is 1 + number of leading entries
+            # with a lower sum, i.e. the first index where the running max reaches the player's sum
+            open_sums = np.maximum.accumulate(
+                np.array([re.sum for _, re in self.rankings[self.open_cat].entries], dtype=np.int64))
+        else: # we'll search for scoring table in scoring
+            score_table=self.scoring_tables[self.scoring]['points']
+
+        contributions = {}
+        for class_name, ranking in self.rankings.items():
+            if ranking is None: continue
+            places = np.array([m for m, _ in ranking.entries], dtype=np.int64)
+            entries = [e for _, e in ranking.entries]
+            dqf = np.array([e.dqf for e in entries], dtype=bool)
+
+            if self.scoring=="proportional":
+                Lu = len(entries) # liczymy DNF do LU
+                if Lu >= 3:
+                    points = proportional_points(places, dqf)
+                    comments = [LazyComment("{0} na {1} = ({1}-{0}+1)*(100/{1}) = ({2}*{3:0.3f})",
+                                            m, Lu, Lu - m + 1, 100 / Lu) for m in places.tolist()]
+                else:
+                    sums = np.array([e.sum for e in entries], dtype=np.int64)
+                    open_places = np.searchsorted(open_sums, sums, side='left') + 1
+                    points = proportional_points(places, dqf, open_places, LuOpen)
+                    comments = [LazyComment("(OPEN) {0} na {1} = ({1}-{2}+1)*(100/{3}) = ({4}*{5:0.2f}) ",
+                                            M, LuOpen + 1, m, Lu, LuOpen + 1 - m + 1, 100 / (LuOpen + 1))
+                                for M, m in zip(open_places.tolist(), places.tolist())]
+                comments = [DNF_COMMENT if e.dqf else c for e, c in zip(entries, comments)]
+            else:
+                dns = np.array([e.dns for e in entries], dtype=bool)
+                points = fixed_points(places, dqf, dns, score_table)
+                comments = [(DNS_COMMENT if e.dns else DNF_COMMENT) if e.dqf else
+                            LazyComment(" miejsce {0} {1}", m, "po dogrywce " if e.sum_tuple[1] > 0 else "")
+                            for e, m in zip(entries, places.tolist())]
+
+            scored = contributions.setdefault(class_name, {})
+            for entry, entry_points, comment in zip(entries, points.tolist(), comments):
+                entry.points = entry_points
+                entry.comment = comment
+                scored[entry.player] = entry
+        return contributions
 
     def render_ranking(self, filename: str,zimowy_rating=False):
-        
-        env = jinja2.Environment(loader=jinja2.FileSystemLoader(os.path.dirname(os.path.realpath(__file__))),
-                                 trim_blocks=True, lstrip_blocks=True)
         if not zimowy_rating:
-            template = env.get_template("dgw.template.html")
+            template = "dgw.template.html"
         else:
-            template = env.get_template("dgw-new.template.html")
+            template = "dgw-new.template.html"
         html_file = f'{filename}'
         logging.info(f"Generating HTML -> {html_file}.")
-        all_results = []
-        for c in self.competitions:
-            if c.sub != []:
-                for s in c.sub:
-                    all_results.extend(s.results)
-            else: #single round competition
-                all_results.extend(c.results)
-        all_results = list(sorted(all_results, key=lambda r: r.rating or 0, reverse=True))
-        #print(all_results)
-        logging.info(f"Results: {len(all_results)}")
-        top_results = all_results[:50]
-        with open(f'{html_file}', 'w', encoding='utf-8') as f:
-            f.write(template.render(data=self, ratings=self.api.cache['ratings'], top_rounds=top_results))
-
-    def zimowy_rating(self,player_id):
-        r_sum=0
-        r_cnt=0
-        for c in self.competitions:
-            for cs in c.sub:
-                if player_id in self.api.cache["ratings"][cs.id]: #player played this round
-                    rat=self.api.cache["ratings"][cs.id][player_id]
-                    if not rat is None: 
-                        r_sum+=rat
-                        r_cnt+=1
-        if r_cnt==0:
-            return "<500"
-        else: # we have a rating
-            init_rat= int(r_sum/r_cnt)
-            r_sum=0
-            r_cnt=0
+        rounds = self.rounds_view or self.build_rounds_view()
+        logging.info(f"Results: {len(rounds.results)}")
+        write_template(template, html_file, data=self, ratings=self.ratings, top_rounds=rounds.top,
+                       round_results=rounds.by_round, zimowy_ratings=self.zimowy_ratings())
+
+    def build_rounds_view(self) -> RoundsView:
+        """Build the view of round results, after the ratings are calculated (reset by `reload`)."""
+        self.rounds_view = RoundsView(self.competitions, self.top_rounds_count)
+        return self.rounds_view
+
+    def render_ranking_lite(self, filename: str, split=False, compress=False):
+        """Lightweight ranking page: a small HTML shell building the tables in the browser from a JSON payload.
+
+        The payload is embedded in the page, or with `split` written next to it - one file for the season and one
+        for every class and competition, loaded when shown (needs a web server). With `compress` every written
+        file gets a gzipped `.gz` copy.
+        """
+        html_file = f'{filename}'
+        logging.info(f"Generating HTML -> {html_file}.")
+        base = os.path.splitext(html_file)[0]
+        data = self.ranking_data()
+        written = [html_file]
+        if split:
+            for idx, class_data in enumerate(data['classes']):
+                class_data['file'] = os.path.basename(f'{base}.class-{idx}.json')
+                write_json(class_data.pop('entries'), f'{base}.class-{idx}.json')
+                written.append(f'{base}.class-{idx}.json')
+            for competition_data in data['competitions']:
+                competition_data['file'] = os.path.basename(f'{base}.competition-{competition_data["id"]}.json')
+                write_json(competition_data.pop('details'), f'{base}.competition-{competition_data["id"]}.json')
+                written.append(f'{base}.competition-{competition_data["id"]}.json')
+            write_json(data, f'{base}.json')
+            written.append(f'{base}.json')
+            write_template("dgw.lite.template.html", html_file, title=self.title,
+                           top_rounds_count=self.top_rounds_count, data_file=os.path.basename(f'{base}.json'))
+        else:
+            payload = json.dumps(data, ensure_ascii=False, separators=(',', ':')).replace('</', '<\\/')
+            write_template("dgw.lite.template.html", html_file, title=self.title,
+                           top_rounds_count=self.top_rounds_count, payload=payload, data_file=None)
+
+        if compress:
+            for name in written:
+                with open(name, 'rb') as src, gzip.GzipFile(f'{name}.gz', 'wb', mtime=0) as dst:
+                    shutil.copyfileobj(src, dst)
+
+    def ranking_data(self) -> dict:
+        """Standings, results and ratings as plain data (the JSON payload of `render_ranking_lite`)."""
+        zimowy_ratings = self.zimowy_ratings()
+        rounds = self.rounds_view or self.build_rounds_view()
+        return {
+            'title': self.title,
+            'competitions': [{'id': c.id, 'name': c.name, 'details': self.competition_data(c)}
+                             for c in self.competitions],
+            'classes': [{'name': cn, 'entries': self.class_data(cn, zimowy_ratings)} for cn in self.entries_sorted],
+            'top_rounds': [[r.competition.name, r.player.name, r.rating] for r in rounds.top],
+            'errors': list(self.errors),
+        }
+
+    def class_data(self, class_name: str, zimowy_ratings: Dict[int, int]) -> List[dict]:
+        entries = []
+        for e in self.entries_sorted[class_name]:
+            results = []
             for c in self.competitions:
-                for cs in c.sub:
-                    if player_id in self.api.cache["ratings"][cs.id]: #player played this round
-                        rat=self.api.cache["ratings"][cs.id][player_id]
-                        if not rat is None and rat>init_rat-100: #exclude rounds more than 100 below init_rating
-                            r_sum+=rat
-                            r_cnt+=1
-            return int(r_sum/r_cnt)
-            
+                r = e.results.get(c.id)
+                results.append(None if r is None else
+                               [r.points, r.place, str(r.comment), r.selected, r.dqf, r.dns])
+            rounds = [[cs.name, self.ratings[cs.id].get(e.player.id) if cs.id in self.ratings else None]
+                      for c in self.competitions if c.id in e.results for cs in c.sub]
+            entries.append({'place': e.place, 'id': e.player.id, 'name': e.player.name, 'sum': e.sum,
+                            'rating': zimowy_ratings.get(e.player.id, '<500'), 'results': results, 'rounds': rounds})
+        return entries
+
+    def competition_data(self, competition: Competition) -> dict:
+        rounds = competition.sub if competition.sub != [] else [competition]
+        round_results = (self.rounds_view or self.build_rounds_view()).by_round
+        return {
+            'rounds': [{'name': cs.name, 'rating_par': cs.rating_par, 'rating_propagators': cs.rating_propagators,
+                        'results': [[r.player.name, r.rating, r.diff] for r in round_results[cs.id]]}
+                       for cs in rounds],
+            'ranking': [{'name': class_name, 'entries': [[m, re.player.name, re.sum, re.diff, re.dqf]
+                                                         for m, re in rl.entries]}
+                        for class_name, rl in competition.ranking],
+        }
+
+    def zimowy_ratings(self) -> Dict[int, int]:
+        """Season rating of every player with a rated round: average of the player's round ratings, without rounds
+        rated more than 100 below the first average. Players without rated rounds are missing ("<500")."""
+        rounds = [self.ratings[cs.id] for c in self.competitions for cs in c.sub if cs.id in self.ratings]
+        players = {}
+        for round_ratings in rounds:
+            for player_id, rat in round_ratings.items():
+                if rat is not None:
+                    players.setdefault(player_id, len(players))
+
+        # player x round rating matrix
+        ratings = np.zeros((len(players), len(rounds)), dtype=np.int64)
+        played = np.zeros((len(players), len(rounds)), dtype=bool)
+        for idx, round_ratings in enumerate(rounds):
+            rated = [(players[player_id], rat) for player_id, rat in round_ratings.items() if rat is not None]
+            if len(rated) > 0:
+                rows, values = zip(*rated)
+                ratings[list(rows), idx] = values
+                played[list(rows), idx] = True
+
+        init_rat = np.trunc(ratings.sum(axis=1) / played.sum(axis=1))
+        kept = played & (ratings > init_rat[:, None] - 100) #exclude rounds more than 100 below init_rating
+        season = np.trunc(np.where(kept, ratings, 0).sum(axis=1) / kept.sum(axis=1))
+        return dict(zip(players, season.astype(np.int64).tolist()))
 
-
-        
     def render_rating(self, filename: str):
-        env = jinja2.Environment(loader=jinja2.FileSystemLoader(os.path.dirname(os.path.realpath(__file__))),
-                                 trim_blocks=True, lstrip_blocks=True)
-        template = env.get_template("dgw.rating.template.html")
         html_file = f'{filename}'
         logging.info(f"Generating HTML -> {html_file}.")
-        all_results = []
-        for c in self.competitions:
-            if c.sub != []:
-                for s in c.sub:
-                    all_results.extend(s.results)
-            else: #single round
-                all_results.extend(c.results)
-        all_results = list(sorted(all_results, key=lambda r: r.rating or 0, reverse=True))
-        logging.info(f"Results: {len(all_results)}")
-        top_results = all_results[:50]
-        with open(f'{html_file}', 'w', encoding='utf-8') as f:
-            f.write(template.render(data=self, ratings=self.api.cache['ratings'], top_rounds=top_results))
+        rounds = self.rounds_view or self.build_rounds_view()
+        logging.info(f"Results: {len(rounds.results)}")
+        write_template("dgw.rating.template.html", html_file, data=self, ratings=self.ratings, top_rounds=rounds.top,
+                       round_results=rounds.by_round)
 
 
 class DgwHtmlHandler(logging.StreamHandler):
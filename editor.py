@@ -13,7 +13,6 @@ import logging
 import logging.handlers
 
 import yaml
-import pdga
 
 import models
 from metrix import MetrixAPI
@@ -196,12 +195,14 @@ class PlayersWidget(DataTable):
 
     def update_current_row(self, player=None):
         player = player or self.edited_player
+        self.app.api.mark_player_changed(player)
         table = self
         table.update_cell(self.edited_cell.row_key, "pdga_id", player.pdga_id)
         table.update_cell(self.edited_cell.row_key, "pdga_rating", player.pdga_rating)
         table.update_cell(self.edited_cell.row_key, "default_category", player.default_category)
 
     def action_fetch(self):
+        import pdga
         table = self
 
         rating = 0
@@ -272,8 +273,10 @@ class RatingsWidget(DataTable):
                 comp.rating_par = None
                 comp.rating_per_stroke = None
                 comp.rating_propagators = None
+                comp.rating_fingerprint = None
                 for r in comp.results:
                     r.rating = None
+                self.app.api.mark_ratings_changed(comp)
                 self.update_cell(self.edited_cell.row_key, "par_rating", "[red]NA[/]")
                 self.update_cell(self.edited_cell.row_key, "per_stroke", 0)
                 self.update_cell(self.edited_cell.row_key, "propagators", 0)
@@ -296,7 +299,8 @@ class RatingsWidget(DataTable):
                 rating.calculate_round_rating(comp, player_lookup,
                                               plotting=True,
                                               outlier_fraction=self.app.config.get("rating", {}).get("outlier_fraction", 0.25),
-                                              prop_min_rating=self.app.config.get("rating", {}).get("prop_min_rating", 500))
+                                              prop_min_rating=self.app.config.get("rating", {}).get("prop_min_rating", 500),
+                                              api=self.app.api)
                 self.update_cell(self.edited_cell.row_key, "par_rating", comp.rating_par)
                 self.update_cell(self.edited_cell.row_key, "per_stroke", comp.rating_per_stroke)
                 self.update_cell(self.edited_cell.row_key, "propagators", comp.rating_propagators)
@@ -323,13 +327,9 @@ class CompetitionsTree(Tree):
     def action_edit(self):
         if isinstance(self.selected_node.data, models.CompetitionResult):
             r: models.CompetitionResult = self.selected_node.data
-            r.playoff_result = (r.playoff_result or 0) + 1 if r.playoff_result < 10 else 0
+            self.app.api.set_playoff_result(r, (r.playoff_result or 0) + 1 if r.playoff_result < 10 else 0)
             self.selected_node.label = f"{self.selected_node.label.split('playoff=')[0]}playoff={r.playoff_result}"
             
-            if r.competition.id not in self.app.api.cache['playoffs']:
-                self.app.api.cache['playoffs'][r.competition.id] = {}            
-            self.app.api.cache['playoffs'][r.competition.id][r.player.id] = r.playoff_result
-            
             self.app.notify(f"Toggled playoff result for {r.player.name} to {r.playoff_result}")
 
     def action_switch(self):
@@ -347,7 +347,7 @@ class CompetitionsTree(Tree):
         if clear:
             self.app.api.cache['competitions'] = {}
             self.app.api.competitions = {}
-            self.app.api.save_cache()
+            self.app.api.save_cache(full=True)
             self.app.api.load_cache()
             self.app.repopulate()
             self.app.notify(f"Cleared cached data.")
@@ -384,16 +384,19 @@ class DGWWidget(Container):
             player_lookup = {
                 player.id: player.pdga_rating for player in dgw.api.players.values() if (player.pdga_rating or 0) > 0
             }
+            outlier_fraction = self.config.get("rating", {}).get("outlier_fraction", 0.25)
+            prop_min_rating = self.config.get("rating", {}).get("prop_min_rating", 500)
+            rounds = []
             for comp in dgw.api.competitions.values():
                 for sub_comp in comp.sub:
-                    if any(r.rating is not None for r in sub_comp.results):
+                    if sub_comp.rating_fingerprint == rating.round_fingerprint(sub_comp, player_lookup,
+                                                                               outlier_fraction, prop_min_rating):
                         logging.warning(f"Skipping calculating ratings for {comp.name}, already in cache.")
                     else:
-                        rating.calculate_round_rating(sub_comp, player_lookup, plotting=True,
-                                                      outlier_fraction=self.config.get("rating", {}).get("outlier_fraction",
-                                                                                                    0.25),
-                                                      prop_min_rating=self.config.get("rating", {}).get("prop_min_rating",
-                                                                                                   500))
+                        rounds.append(sub_comp)
+            fits = rating.rate_rounds(rounds, player_lookup, outlier_fraction=outlier_fraction,
+                                      prop_min_rating=prop_min_rating, api=self.api)
+            rating.plot_rounds(zip(rounds, fits), max_workers=1)
 
             logger.removeHandler(handler)
             html_file = f'{league_id}.ranking.html'
@@ -433,12 +436,12 @@ class CacheEditorApp(App):
     def __init__(self, args):
         super().__init__()
         self.args = args
-        self.api = MetrixAPI(cache_file=args.cache_file)
         try:
             self.config = yaml.load(open(args.config, 'r'), Loader=yaml.CLoader)
         except IOError as e:
             logging.exception(f"Loading config file '{args.config}' failed.")
             raise SystemExit(1)
+        self.api = MetrixAPI(cache_file=args.cache_file, **self.config.get("metrix", {}))
 
     def repopulate(self):
         player_table = self.query_one("DataTable#players")
@@ -465,7 +468,7 @@ class CacheEditorApp(App):
                     r_node.add_leaf(f"{i+1:2}. {r.player.name} {'[red]+' if r.diff > 0 else '[green]'}{r.diff}[/] ({r.sum}) rating=[yellow]{r.rating}[/yellow] DNF={r.dnf} playoff={r.playoff_result}", data=r)
             tree.root.expand()
 
-        for p in sorted(set(self.api.players.values()), key=lambda p: p.name):
+        for p in sorted(self.api.players, key=lambda p: p.name):
             player_table.add_player(p)
 
         logging.info(f"Players: {len(self.api.cache['players'])}")
@@ -529,7 +532,6 @@ class CacheEditorApp(App):
 
 
     def action_repopulate(self):
-        self.api.load_cache()
         self.push_screen(ConfirmModal("Save and repopulate widgets?"), self.repopulate_on_confirm)
 
     def repopulate_on_confirm(self, repopulate: bool):
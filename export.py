@@ -0,0 +1,137 @@
+import json
+import logging
+from typing import Dict, Iterable, List, Tuple
+
+from dgw import ZimowyDGW
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+"""export.py: Machine readable export of standings, rankings, ratings and scores (JSON Lines, Parquet)."""
+
+__author__ = "Jakub Wroniecki"
+__copyright__ = "Copyright 2022, Jakub Wroniecki, see LICENSE.txt for details."
+
+
+# tables: name -> columns (name, pyarrow type name)
+TABLES: Dict[str, List[Tuple[str, str]]] = {
+    'standings': [('class_name', 'string'), ('place', 'int64'), ('player_id', 'int64'), ('player_name', 'string'),
+                  ('points', 'int64'), ('competition_id', 'int64'), ('competition_points', 'int64'),
+                  ('competition_place', 'int64'), ('selected', 'bool_'), ('dqf', 'bool_'), ('dns', 'bool_')],
+    'rankings': [('competition_id', 'int64'), ('competition_name', 'string'), ('class_name', 'string'),
+                 ('place', 'int64'), ('player_id', 'int64'), ('player_name', 'string'), ('sum', 'int64'),
+                 ('diff', 'int64'), ('playoff_result', 'int64'), ('dqf', 'bool_'), ('dns', 'bool_'),
+                 ('points', 'int64')],
+    'ratings': [('competition_id', 'int64'), ('round_id', 'int64'), ('round_name', 'string'),
+                ('rating_par', 'int64'), ('rating_per_stroke', 'float64'), ('player_id', 'int64'),
+                ('player_name', 'string'), ('sum', 'int64'), ('diff', 'int64'), ('rating', 'int64')],
+    'scores': [('competition_id', 'int64'), ('round_id', 'int64'), ('player_id', 'int64'), ('hole', 'int64'),
+               ('result', 'int64'), ('diff', 'int64')],
+}
+
+
+class TableWriter:
+    """Writes rows of one table to `<base>.<table>.jsonl` and, if pyarrow is installed, `<base>.<table>.parquet`.
+
+    Parquet rows are written in row groups of `batch_size` rows, so memory use does not depend on the table size.
+    """
+
+    def __init__(self, base: str, table: str, parquet=True, batch_size=10000):
+        self.filenames = [f'{base}.{table}.jsonl']
+        self.jsonl = open(f'{base}.{table}.jsonl', 'w', encoding='utf-8')
+        self.parquet = None
+        self.batch_size = batch_size
+        self.batch: List[dict] = []
+        if parquet and pa is not None:
+            self.schema = pa.schema([(name, getattr(pa, type_name)()) for name, type_name in TABLES[table]])
+            self.parquet = pq.ParquetWriter(f'{base}.{table}.parquet', self.schema)
+            self.filenames.append(f'{base}.{table}.parquet')
+
+    def write(self, row: dict):
+        self.jsonl.write(json.dumps(row, ensure_ascii=False))
+        self.jsonl.write('\n')
+        if self.parquet is not None:
+            self.batch.append(row)
+            if len(self.batch) >= self.batch_size:
+                self.flush()
+
+    def flush(self):
+        if self.parquet is not None and len(self.batch) > 0:
+            self.parquet.write_table(pa.Table.from_pylist(self.batch, schema=self.schema))
+            self.batch = []
+
+    def close(self):
+        self.flush()
+        self.jsonl.close()
+        if self.parquet is not None:
+            self.parquet.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def standings_rows(dgw: ZimowyDGW) -> Iterable[dict]:
+    """Season standings (`entries_sorted`), one row per player and competition in the class."""
+    for class_name, entries in dgw.entries_sorted.items():
+        for e in entries:
+            for competition_id, r in e.results.items():
+                yield {'class_name': class_name, 'place': e.place, 'player_id': e.player.id,
+                       'player_name': e.player.name, 'points': e.sum, 'competition_id': competition_id,
+                       'competition_points': r.points, 'competition_place': r.place, 'selected': r.selected,
+                       'dqf': r.dqf, 'dns': r.dns}
+
+
+def ranking_rows(dgw: ZimowyDGW) -> Iterable[dict]:
+    """Rankings of the competitions by class, `points` as scored for the season."""
+    for c in dgw.competitions:
+        for class_name, rl in c.ranking:
+            for place, re in rl.entries:
+                yield {'competition_id': c.id, 'competition_name': c.name, 'class_name': class_name,
+                       'place': place, 'player_id': re.player.id, 'player_name': re.player.name, 'sum': re.sum,
+                       'diff': re.diff, 'playoff_result': re.sum_tuple[1], 'dqf': re.dqf, 'dns': re.dns,
+                       'points': re.points}
+
+
+def rounds(dgw: ZimowyDGW):
+    for c in dgw.competitions:
+        for s in (c.sub if c.sub != [] else [c]):
+            yield c, s
+
+
+def rating_rows(dgw: ZimowyDGW) -> Iterable[dict]:
+    """Player ratings of every round."""
+    for c, s in rounds(dgw):
+        for r in s.results:
+            yield {'competition_id': c.id, 'round_id': s.id, 'round_name': s.name, 'rating_par': s.rating_par,
+                   'rating_per_stroke': s.rating_per_stroke, 'player_id': r.player.id,
+                   'player_name': r.player.name, 'sum': r.sum, 'diff': r.diff, 'rating': r.rating}
+
+
+def score_rows(dgw: ZimowyDGW) -> Iterable[dict]:
+    """Per-hole scores of every round, `hole` is the position of the score in the round."""
+    for c, s in rounds(dgw):
+        for r in s.results:
+            for hole, (result, diff) in enumerate(zip(r.scores.results, r.scores.diffs), start=1):
+                yield {'competition_id': c.id, 'round_id': s.id, 'player_id': r.player.id, 'hole': hole,
+                       'result': result, 'diff': diff}
+
+
+def export(dgw: ZimowyDGW, base: str, parquet=True) -> List[str]:
+    """Write all tables of the league, returns names of the written files."""
+    if parquet and pa is None:
+        logging.warning("pyarrow not installed - exporting JSON Lines only.")
+    written = []
+    for table, rows in (('standings', standings_rows), ('rankings', ranking_rows), ('ratings', rating_rows),
+                        ('scores', score_rows)):
+        logging.info(f"Exporting {table} -> {base}.{table}.jsonl")
+        with TableWriter(base, table, parquet=parquet) as writer:
+            for row in rows(dgw):
+                writer.write(row)
+        written.extend(writer.filenames)
+    return written
@@ -1,5 +1,8 @@
 import logging
+import pickle
+from concurrent.futures import ProcessPoolExecutor
 from dgw import ZimowyDGW, DgwHtmlHandler
+from metrix import MetrixAPI
 
 """main.py: Generator rankingu Zimowej Ligi DGW."""
 
@@ -8,11 +11,8 @@ __copyright__ = "Copyright 2022, Jakub Wroniecki, see LICENSE.txt for details."
 
 
 def main(args):
-    import jinja2
-    import os
     import yaml
     from rich.logging import RichHandler
-    from pprint import pprint
 
     logger = logging.getLogger()
     logger.addHandler(RichHandler())
@@ -23,12 +23,11 @@ def main(args):
         logging.exception(f"Loading config file '{args.config}' failed.")
         return
 
-    if args.league not in config['leagues']:
+    league_ids = list(config['leagues'].keys()) if args.all_leagues else args.league
+    league_ids = [league_id for league_id in league_ids if league_id in config['leagues']]
+    if len(league_ids) == 0:
         #print(f"{args.league} not found in {args.config}.")
         return
-    else:
-        league = config['leagues'].get(args.league)
-
 
     if args.quiet > 0:
         logger.setLevel(logging.ERROR)
@@ -40,71 +39,160 @@ def main(args):
     # env = jinja2.Environment(loader=jinja2.FileSystemLoader(os.path.dirname(os.path.realpath(__file__))),
     #                          trim_blocks=True, lstrip_blocks=True)
     # template = env.get_template("dgw.template.html")
+
+    api = MetrixAPI(cache_file=args.cache_file, max_workers=args.fetch_workers, **config.get("metrix", {}))
+
+    rated = set() # rounds rated in this run, shared by leagues
+    if len(league_ids) == 1:
+        league_id = league_ids[0]
+        dgw = load_league(api, config, league_id, args)
+        logger.addHandler(DgwHtmlHandler(dgw))
+        dgw.reload(refresh=args.refresh)
+        plots = calculate_ratings(dgw, config, args, rated)
+        dgw.api.save_cache()
+        dgw.build_rounds_view()
+        render_league(dgw, league_id, args)
+        plot_ratings(plots, args)
+        return
+
+    # leagues share the API (downloads, parsed competitions) and ratings; each league is scored right before it is
+    # pickled for rendering, since leagues sharing a competition score the same ranking entries
+    futures = []
+    plots = []
+    with ProcessPoolExecutor(max_workers=args.render_workers) as executor:
+        for league_id in league_ids:
+            dgw = load_league(api, config, league_id, args)
+            handler = DgwHtmlHandler(dgw)
+            logger.addHandler(handler)
+            dgw.reload(refresh=args.refresh)
+            plots.extend(calculate_ratings(dgw, config, args, rated))
+            dgw.api.save_cache()
+            dgw.build_rounds_view()
+            logger.removeHandler(handler)
+            futures.append(executor.submit(render_league_worker, pickle.dumps(dgw), league_id, args, logger.level))
+
+        # plotted while the leagues are rendered
+        plot_ratings(plots, args)
+        for future in futures:
+            future.result()
+
+
+def load_league(api: MetrixAPI, config: dict, league_id: str, args) -> ZimowyDGW:
+    league = config['leagues'].get(league_id)
     default_categories = config.get("dgw", {}).get("default_categories")
     scoring_tables = config.get("dgw", {}).get("scoring_tables", {})
 
-    dgw = ZimowyDGW(league.get('competition_ids'), league.get('title'), 
-                    categories=league.get("categories"),
-                    scoring=league.get("scoring"),cache_file=args.cache_file, ignore_holes=league.get("ignore_holes"),
-                    default_categories=default_categories,
-                    scoring_tables=scoring_tables,
-                    use_default_categories=args.use_default_categories
-                    )
-    logger.addHandler(DgwHtmlHandler(dgw))
-    dgw.reload()
-
-    if not args.skip_ratings:
-        import rating
-        #print("not skip")
-        player_lookup = {
-            player.id: player.pdga_rating for player in dgw.api.players.values() if (player.pdga_rating or 0) > 0
-        }
-        for comp in dgw.api.competitions.values():
-            #print("considering round",comp.id, "with subs",comp.sub)
-            if comp.sub==[]: # simple 1-round competition
-                if any(r.rating is not None for r in comp.results) and not args.force_ratings:
-                    logging.warning(f"Skipping calculating ratings for {comp.name}, already in cache.")
-                else:
-                    #print("kalkulacja ratingu dla rundy",comp)
-                    rating.calculate_round_rating(comp, player_lookup, plotting=True,
-                                                  outlier_fraction=config.get("rating", {}).get("outlier_fraction", 0.25),
-                                                  prop_min_rating=config.get("rating", {}).get("prop_min_rating", 500))
-            else:
-                for sub_comp in comp.sub:
-                    if any(r.rating is not None for r in sub_comp.results) and not args.force_ratings:
-                        logging.warning(f"Skipping calculating ratings for {comp.name}, already in cache.")
-                    else:
-                        print("kalkulacja ratingu dla rundy",sub_comp.name)
-                        rating.calculate_round_rating(sub_comp, player_lookup, plotting=True,
-                                                  outlier_fraction=config.get("rating", {}).get("outlier_fraction", 0.25),
-                                                  prop_min_rating=config.get("rating", {}).get("prop_min_rating", 500))
-    else:
+    return ZimowyDGW(league.get('competition_ids'), league.get('title'), 
+                     categories=league.get("categories"),
+                     scoring=league.get("scoring"),cache_file=args.cache_file, ignore_holes=league.get("ignore_holes"),
+                     default_categories=default_categories,
+                     scoring_tables=scoring_tables,
+                     best_of=league.get("best_of", 7),
+                     top_rounds=league.get("top_rounds", 50),
+                     use_default_categories=args.use_default_categories,
+                     api=api
+                     )
+
+
+def calculate_ratings(dgw: ZimowyDGW, config: dict, args, rated: set) -> list:
+    """Rate the rounds of `dgw` competitions, skipping rounds already rated in this run, or rated in the cache from
+    the same inputs (`rating.round_fingerprint`).
+
+    Returns the rated rounds with their fits, for `plot_ratings`.
+    """
+    if args.skip_ratings:
         logging.info("Skipping ratings calculation.")
+        return []
+
+    import rating
+    #print("not skip")
+    player_lookup = {
+        player.id: player.pdga_rating for player in dgw.api.players.values() if (player.pdga_rating or 0) > 0
+    }
+    outlier_fraction = config.get("rating", {}).get("outlier_fraction", 0.25)
+    prop_min_rating = config.get("rating", {}).get("prop_min_rating", 500)
+    rounds = []
+    # sub-rounds are also registered in api.competitions, only the league's competitions list each round once
+    for comp in dgw.competitions:
+        #print("considering round",comp.id, "with subs",comp.sub)
+        for sub_comp in (comp.sub if comp.sub != [] else [comp]):
+            if sub_comp.id in rated or (not args.force_ratings and sub_comp.rating_fingerprint ==
+                                        rating.round_fingerprint(sub_comp, player_lookup, outlier_fraction,
+                                                                 prop_min_rating)):
+                logging.warning(f"Skipping calculating ratings for {comp.name}, already in cache.")
+            else:
+                if comp.sub != []:
+                    print("kalkulacja ratingu dla rundy",sub_comp.name)
+                rounds.append(sub_comp)
 
-    dgw.api.save_cache()
+    fits = rating.rate_rounds(rounds, player_lookup, outlier_fraction=outlier_fraction,
+                              prop_min_rating=prop_min_rating, max_workers=args.rating_workers, api=dgw.api)
+    rated.update(comp.id for comp in rounds)
+    return list(zip(rounds, fits))
 
+
+def plot_ratings(plots: list, args):
+    """Plot the fits of the rounds rated in this run."""
+    if args.no_plots or len(plots) == 0:
+        return
+
+    import rating
+    rating.plot_rounds(plots, max_workers=args.plot_workers)
+
+
+def render_league(dgw: ZimowyDGW, league_id: str, args):
     if not args.zimowy_rating: 
-        html_file = f'{args.league}.ranking.html'
+        html_file = f'{league_id}.ranking.html'
     else: #add zimowy_rating
-        html_file = f'{args.league}.ranking-new.html'
-    dgw.render_ranking(html_file,args.zimowy_rating)
+        html_file = f'{league_id}.ranking-new.html'
+    if args.lite:
+        dgw.render_ranking_lite(html_file, split=args.split, compress=args.gzip)
+    else:
+        dgw.render_ranking(html_file,args.zimowy_rating)
     
-    html_file = f'{args.league}.rating.html'
+    html_file = f'{league_id}.rating.html'
     dgw.render_rating(html_file)
 
+    if args.export:
+        import export
+        export.export(dgw, league_id)
+
     # logging.info(f"Generating HTML -> {html_file}.")
     # with open(f'{html_file}', 'w', encoding='utf-8') as f:
     #     f.write(template.render(data=dgw, ratings=dgw.api.cache['ratings']))
 
 
+def render_league_worker(data: bytes, league_id: str, args, log_level: int):
+    """Render a pickled ZimowyDGW in a worker process."""
+    dgw: ZimowyDGW = pickle.loads(data)
+    logger = logging.getLogger()
+    logger.setLevel(log_level)
+    # workers are reused for other leagues - errors of this one must not end up on their pages
+    handler = DgwHtmlHandler(dgw)
+    logger.addHandler(handler)
+    try:
+        render_league(dgw, league_id, args)
+    finally:
+        logger.removeHandler(handler)
+
+
 if __name__ == '__main__':
     import argparse
     import os
 
     argparser = argparse.ArgumentParser()
-    argparser.add_argument('--league', '-l', type=str, required=True)
+    argparser.add_argument('--league', '-l', type=str, action='append', default=[],
+                           help="League from the config file, may be given more than once.")
+    argparser.add_argument('--all-leagues', action='store_true', help="Generate rankings of all leagues in the config file.")
+    argparser.add_argument('--render-workers', type=int, default=None,
+                           help="Number of processes rendering HTML when generating more than one league.")
     argparser.add_argument('--skip-ratings', action='store_true')
     argparser.add_argument('--force-ratings', action='store_true', help="Force ratings calculation, ignore cached values.")
+    argparser.add_argument('--rating-workers', type=int, default=None,
+                           help="Number of processes fitting round ratings (default: fit in the main process).")
+    argparser.add_argument('--no-plots', action='store_true', help="Do not plot the rating fits of the rounds.")
+    argparser.add_argument('--plot-workers', type=int, default=None,
+                           help="Number of processes plotting the rating fits.")
     argparser.add_argument('--use-default-categories', action='store_true')
     argparser.add_argument('--config', '-c', type=str,
                            default=os.path.join(os.path.dirname(os.path.realpath(__file__)),
@@ -113,9 +201,24 @@ if __name__ == '__main__':
     argparser.add_argument('--cache-file', type=str,
                            default=os.path.join(os.path.dirname(os.path.realpath(__file__)),
                                                 'results.cache.pkl'))
+    argparser.add_argument('--refresh', action='store_true',
+                           help="Refetch cached competitions that may have changed since they were downloaded.")
+    argparser.add_argument('--fetch-workers', type=int, default=8,
+                           help="Number of concurrent downloads from discgolfmetrix.com.")
     argparser.add_argument('-v', action="count", dest="verbose", default=0)
     argparser.add_argument('--quiet', '-q', action="store_const", const=True, default=False)
     argparser.add_argument('--zimowy-rating', '-z', action="store_const", const=True, default=False)
-
-    main(argparser.parse_args())
+    argparser.add_argument('--lite', action='store_true',
+                           help="Lightweight ranking page - tables are built in the browser from a JSON payload.")
+    argparser.add_argument('--split', action='store_true',
+                           help="With --lite: write the payload to separate files for the season, classes and competitions.")
+    argparser.add_argument('--gzip', action='store_true', help="With --lite: write gzipped .gz copies of the files.")
+    argparser.add_argument('--export', action='store_true',
+                           help="Export standings, rankings, ratings and hole scores as JSON Lines (and Parquet, "
+                                "if pyarrow is installed).")
+
+    args = argparser.parse_args()
+    if not args.league and not args.all_leagues:
+        argparser.error("one of the arguments --league/-l --all-leagues is required")
+    main(args)
 
@@ -1,10 +1,15 @@
 import logging
 import os.path
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import datetime
-from typing import Dict
-import pickle
+import hashlib
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+from cache import CacheBackend, empty_cache, empty_changes, open_cache
 from models import Competition, Player, Course, Track, Score, CompetitionResult
 
 """metrix.py: Wrapper for  discgolfmetrix.com API (see https://discgolfmetrix.com/?u=rule&ID=37 )."""
@@ -17,88 +22,270 @@ class MetrixAPIError(BaseException):
     pass
 
 
+class RecordingHandler(logging.Handler):
+    """Collects log records (e.g. warnings about results, logged while parsing a competition)."""
+
+    def __init__(self):
+        super().__init__()
+        self.records: List[logging.LogRecord] = []
+
+    def emit(self, record: logging.LogRecord):
+        self.records.append(record)
+
+
+class PlayerRegistry:
+    """Players by their canonical ID, with a normalized-name index and an alias table.
+
+    Registered Metrix users are keyed by their user ID, guests by `name_id()` - a stable hash of the normalized name.
+    A user ID seen for a name that is already known becomes an alias of the existing player, so guest entries and
+    registered accounts of the same person resolve to one Player.
+    """
+
+    def __init__(self):
+        self._by_id: Dict[int, Player] = {}
+        self._aliases: Dict[int, int] = {}
+        self._by_name: Dict[str, int] = {}
+
+    @staticmethod
+    def normalize_name(name: str) -> str:
+        if not isinstance(name, str):
+            raise TypeError(f"Player name must be a string, not {type(name).__name__}")
+        return " ".join(name.split()).upper()
+
+    @classmethod
+    def name_id(cls, name: str) -> int:
+        # negative, so it never collides with Metrix user IDs; hashlib instead of hash() - same value in every run
+        return -int.from_bytes(hashlib.sha1(cls.normalize_name(name).encode('utf-8')).digest()[:7], 'big')
+
+    def get(self, id: int) -> Optional[Player]:
+        return self._by_id.get(self._aliases.get(id, id))
+
+    def by_name(self, name: str) -> Optional[Player]:
+        id = self._by_name.get(self.normalize_name(name))
+        return self._by_id.get(id) if id is not None else None
+
+    def add(self, player: Player) -> Player:
+        self._by_id[player.id] = player
+        self._by_name.setdefault(self.normalize_name(player.name), player.id)
+        return player
+
+    def alias(self, id: int, player: Player):
+        if id != player.id:
+            self._aliases[id] = player.id
+
+    def resolve(self, user_id: Optional[int], name: str) -> Tuple[Player, bool]:
+        """Player for a result row - returns (player, created)."""
+        player = self.by_name(name)
+        if player is None and user_id is not None:
+            player = self.get(user_id)
+        created = player is None
+        if created:
+            player = self.add(Player(id=user_id if user_id is not None else self.name_id(name), name=name))
+        elif user_id is not None and user_id not in self._by_id:
+            self.alias(user_id, player)
+        self._by_name[self.normalize_name(name)] = player.id
+        return player, created
+
+    def __contains__(self, id: int) -> bool:
+        return self._aliases.get(id, id) in self._by_id
+
+    def __getitem__(self, id: int) -> Player:
+        player = self.get(id)
+        if player is None:
+            raise KeyError(id)
+        return player
+
+    def __iter__(self) -> Iterator[Player]:
+        return iter(self._by_id.values())
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def values(self) -> Iterable[Player]:
+        return self._by_id.values()
+
+
 class MetrixAPI:
+    API_URL = 'https://discgolfmetrix.com/api.php'
 
-    def __init__(self, cache_file=None):
+    def __init__(self, cache_file=None, api_url=None, max_workers=8, cache_backend: CacheBackend = None,
+                 timeout=30, retries=3, backoff=0.5, refresh_ttl=3600, immutable_after=7):
         self.courses: Dict[int, Course] = {}
-        self.players: Dict[int, Player] = {}
+        self.players = PlayerRegistry()
         self.competitions: Dict[int, Competition] = {}
         self.sub_competitions: Dict[int, Competition] = {}
+        self._parsed: Dict[int, Tuple[tuple, frozenset, Competition, List[logging.LogRecord]]] = {}
         self._cache_file = None
-        self.cache = {
-            'competitions': {},
-            'players': [],
-            'ratings': {},
-            'ratings_info': {},
-        }
+        self.api_url = api_url or self.API_URL
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.refresh_ttl = datetime.timedelta(seconds=refresh_ttl)
+        self.immutable_after = datetime.timedelta(days=immutable_after)
+        self.session = requests.Session()
+        retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=('GET',))
+        self.session.mount('https://', HTTPAdapter(pool_maxsize=max_workers, max_retries=retry))
+        self.session.mount('http://', HTTPAdapter(pool_maxsize=max_workers, max_retries=retry))
+        self.cache = empty_cache()
+        self._changes = empty_changes()
+        self._changed_ratings: Dict[int, Competition] = {}
 
         if cache_file is not None:
             self._cache_file = cache_file
 
+        self._cache_backend = cache_backend
+        if self._cache_backend is None and self._cache_file is not None:
+            self._cache_backend = open_cache(self._cache_file)
+
         self.load_cache()
 
     def load_cache(self):
-        if self._cache_file is not None and os.path.isfile(self._cache_file):
-            with open(self._cache_file, 'rb') as f:
-                self.cache = pickle.load(f)
-
-            if 'ratings' not in self.cache:
-                self.cache['ratings'] = {}
-            if 'ratings_info' not in self.cache:
-                self.cache['ratings_info'] = {}
-            if 'competitions' not in self.cache:
-                self.cache['competitions'] = {}
-            if 'players' not in self.cache:
-                self.cache['players'] = []
-            if 'playoffs' not in self.cache:
-                self.cache['playoffs'] = {}
+        self._changes = empty_changes()
+        self._changed_ratings = {}
+        if self._cache_backend is not None:
+            self.cache = self._cache_backend.load()
 
             for p in self.cache['players']:
-                self.players[p.id] = p
-                self.players[hash(p.name.upper())] = p
+                self.players.add(p)
+        else:
+            self.cache = empty_cache()
+
+    def save_cache(self, full=False):
+        """Store the cache. By default only records marked as changed since the last save are written,
+        `full=True` rebuilds players and ratings from all loaded competitions and rewrites the whole cache."""
+        if full:
+            self.cache['players'] = list(sorted(self.players, key=lambda p: p.name))
+            rated = [c for c in self.competitions.values() if len(c.sub) == 0]
         else:
-            self.cache = {
-                'competitions': {},
-                'players': [],
-                'ratings': {},
-                'ratings_info': {}, 
-                'playoffs': {},
-            }
-
-    def save_cache(self):
-        players_set = set()
-        for p in self.players.values():
-            players_set.add(p)
-        self.cache['players'] = list(sorted(players_set, key=lambda p: p.name))
-
-        for c in self.competitions.values():            
-            for c_sub in c.sub:
-                if any(r.rating is not None for r in c_sub.results):
-                    self.cache['ratings'][c_sub.id] = {r.player.id: r.rating for r in c_sub.results}
-                    self.cache['ratings_info'][c_sub.id] = {
-                        "rating_par": c_sub.rating_par,
-                        "rating_propagators": c_sub.rating_propagators,
-                        "rating_per_stroke": c_sub.rating_per_stroke,
-                    }
-                else:
-                    self.cache['ratings'].pop(c_sub.id, None)
-                    self.cache['ratings_info'].pop(c_sub.id, None)
-
-        if self._cache_file is not None:
-            with open(self._cache_file, 'wb') as f:
-                pickle.dump(self.cache, f)
+            rated = self._changed_ratings.values()
+
+        for c_sub in rated:
+            if any(r.rating is not None for r in c_sub.results):
+                self.cache['ratings'][c_sub.id] = {r.player.id: r.rating for r in c_sub.results}
+                self.cache['ratings_info'][c_sub.id] = {
+                    "rating_par": c_sub.rating_par,
+                    "rating_propagators": c_sub.rating_propagators,
+                    "rating_per_stroke": c_sub.rating_per_stroke,
+                    "rating_fingerprint": c_sub.rating_fingerprint,
+                }
+            else:
+                self.cache['ratings'].pop(c_sub.id, None)
+                self.cache['ratings_info'].pop(c_sub.id, None)
+            self._changes['ratings'].add(c_sub.id)
+            self._changes['ratings_info'].add(c_sub.id)
+
+        if self._cache_backend is not None:
+            if full:
+                self._cache_backend.save(self.cache)
+            elif any(len(keys) > 0 for keys in self._changes.values()):
+                self._cache_backend.save_changes(self.cache, self._changes)
+
+        self._changes = empty_changes()
+        self._changed_ratings = {}
+
+    def mark_player_changed(self, player: Player):
+        self._changes['players'].add(player)
+
+    def mark_ratings_changed(self, competition: Competition):
+        self._changed_ratings[competition.id] = competition
+
+    def set_playoff_result(self, result: CompetitionResult, playoff_result: int):
+        result.playoff_result = playoff_result
+        result.competition.invalidate_ranking()
+        self.cache['playoffs'].setdefault(result.competition.id, {})[result.player.id] = playoff_result
+        self._changes['playoffs'].add(result.competition.id)
+
+    def download_results_json(self, competition_id: int, fetch_info: dict = None) -> Tuple[Optional[dict], dict]:
+        """Download competition results. When `fetch_info` (ETag/Last-Modified of the cached reply) is given, the
+        request is conditional and the returned reply is None if the server answered 304 Not Modified."""
+        url = f'{self.api_url}?content=result&id={competition_id}'
+        headers = {}
+        if fetch_info:
+            if fetch_info.get('etag'):
+                headers['If-None-Match'] = fetch_info['etag']
+            if fetch_info.get('last_modified'):
+                headers['If-Modified-Since'] = fetch_info['last_modified']
+        logging.info(f"Fetching: {url}{' (conditional)' if headers else ''}")
+        result = self.session.get(url, headers=headers, timeout=self.timeout)
+        if result.status_code == 304:
+            return None, dict(fetch_info, fetched_at=time.time())
+        result.raise_for_status()
+        return result.json(), {'etag': result.headers.get('ETag'), 'last_modified': result.headers.get('Last-Modified'),
+                               'fetched_at': time.time()}
 
     def fetch_results_json(self, competition_id: int):
 
         if competition_id not in self.cache['competitions']:
-            url = f'https://discgolfmetrix.com/api.php?content=result&id={competition_id}'
-            logging.info(f"Fetching: {url}")
-            result = requests.get(url)
-            reply = result.json()
+            reply, fetch_info = self.download_results_json(competition_id)
             self.cache['competitions'][competition_id] = reply
+            self.cache['fetch_info'][competition_id] = fetch_info
+            self._changes['competitions'].add(competition_id)
+            self._changes['fetch_info'].add(competition_id)
 
         return self.cache['competitions'][competition_id]
 
+    def is_stale(self, competition_id: int, now: datetime.datetime = None) -> bool:
+        """Whether a competition should be (re)fetched. Competitions fetched at least `immutable_after` after
+        their date are final; more recent ones are revalidated when fetched more than `refresh_ttl` ago."""
+        if competition_id not in self.cache['competitions']:
+            return True
+        fetched_at = (self.cache['fetch_info'].get(competition_id) or {}).get('fetched_at')
+        if fetched_at is None:
+            return True
+        fetched_at = datetime.datetime.fromtimestamp(fetched_at)
+        date = self.cache['competitions'][competition_id].get('Competition', {}).get('Date')
+        if date is not None and fetched_at - datetime.datetime.strptime(date, '%Y-%m-%d') >= self.immutable_after:
+            return False
+        return (now or datetime.datetime.now()) - fetched_at >= self.refresh_ttl
+
+    @staticmethod
+    def sub_event_ids(reply) -> List[int]:
+        """IDs of sub events that have to be fetched separately (competitions listing `Events` instead of
+        `SubCompetitions`)."""
+        data = reply.get("Competition", {})
+        events = [int(event['ID']) for event in data.get("Events", None) or []]
+        sub_competitions = [int(sub['ID']) for sub in data.get("SubCompetitions", None) or []]
+        # older caches stored fetched sub events in SubCompetitions of the parent reply
+        if len(sub_competitions) > 0 and sub_competitions != events:
+            return []
+        return events
+
+    def prefetch(self, competition_ids: Iterable[int], max_workers=None, refresh=False) -> Dict[int, dict]:
+        """Fetch all competitions and their sub events missing from the cache, using a pool of worker threads.
+        With `refresh=True` stale cached competitions (see `is_stale`) are revalidated with conditional requests too.
+
+        The cache is updated only after every download succeeded, so a failed prefetch leaves it unchanged.
+        """
+        max_workers = max_workers or self.max_workers
+        cached = self.cache['competitions']
+        fetched: Dict[int, dict] = {}
+        fetch_info: Dict[int, dict] = {}
+
+        def download(ids):
+            ids = [i for i in dict.fromkeys(ids) if i not in fetch_info and (i not in cached or
+                                                                             (refresh and self.is_stale(i)))]
+            if len(ids) == 0:
+                return
+            validators = [self.cache['fetch_info'].get(i) if i in cached else None for i in ids]
+            with ThreadPoolExecutor(max_workers=min(max_workers, len(ids))) as executor:
+                for i, (reply, info) in zip(ids, executor.map(self.download_results_json, ids, validators)):
+                    fetch_info[i] = info
+                    if reply is not None:
+                        fetched[i] = reply
+
+        competition_ids = list(competition_ids)
+        download(competition_ids)
+        download(event_id for competition_id in competition_ids
+                 for event_id in self.sub_event_ids(fetched.get(competition_id) or cached[competition_id]))
+
+        cached.update(fetched)
+        self.cache['fetch_info'].update(fetch_info)
+        self._changes['competitions'].update(fetched)
+        self._changes['fetch_info'].update(fetch_info)
+        if refresh:
+            logging.info(f"Refreshed {len(fetch_info)} competitions, {len(fetched)} changed.")
+        return fetched
+
     def results(self, competition_id: int,ignore_holes=None):
         if competition_id not in self.competitions:
             reply = self.fetch_results_json(competition_id)
@@ -109,23 +296,43 @@ class MetrixAPI:
             raise MetrixAPIError(f'Missing key - "Competition" in API reply (content=result)')
 
         data = reply.get("Competition")
-        if "Events" in data and len(data.get("Events", [])) > 0 \
-                and len(data.get("SubCompetitions", [])) == 0:
+        sub_competitions = data.get('SubCompetitions', [])
+        event_ids = self.sub_event_ids(reply)
+        if len(event_ids) > 0:
 
             sub_competitions = []
-            for event in data['Events']:
-                sub_event_results = self.fetch_results_json(int(event['ID']))
+            for event_id in event_ids:
+                sub_event_results = self.fetch_results_json(event_id)
                 if 'Competition' not in sub_event_results:
-                    raise MetrixAPIError(f'Missing key - "Competition" in API reply for sub event ID={event["ID"]}')
+                    raise MetrixAPIError(f'Missing key - "Competition" in API reply for sub event ID={event_id}')
                 sub_competitions.append(sub_event_results['Competition'])
-            data['SubCompetitions'] = sub_competitions
 
-        competition = self.get_competition_from_json(data,ignore_holes)
-        for sub_data in data.get('SubCompetitions', []):
-            sub_competition = self.get_competition_from_json(sub_data,ignore_holes)
-            competition.sub.append(sub_competition)
-            sub_competition.parent = competition
-            self.sub_competitions[sub_competition.id] = sub_competition
+        # raw replies are replaced in the cache whenever they are fetched again, so their identity
+        # fingerprints the data a parsed competition was built from
+        replies = (data, *sub_competitions)
+        ignored = frozenset(ignore_holes or ())
+        if competition_id in self._parsed:
+            parsed_replies, parsed_ignored, parsed, parse_log = self._parsed[competition_id]
+            if parsed is self.competitions.get(competition_id) and parsed_ignored == ignored \
+                    and len(parsed_replies) == len(replies) and all(a is b for a, b in zip(parsed_replies, replies)):
+                # warnings about the results are reported again, like when the competition is parsed
+                for record in parse_log:
+                    logging.getLogger().handle(record)
+                return parsed
+
+        recording = RecordingHandler()
+        logging.getLogger().addHandler(recording)
+        try:
+            competition = self.get_competition_from_json(data,ignore_holes)
+            competition.sub = []
+            for sub_data in sub_competitions:
+                sub_competition = self.get_competition_from_json(sub_data,ignore_holes)
+                competition.sub.append(sub_competition)
+                sub_competition.parent = competition
+                self.sub_competitions[sub_competition.id] = sub_competition
+        finally:
+            logging.getLogger().removeHandler(recording)
+        self._parsed[competition_id] = (replies, ignored, competition, recording.records)
 
         # print(data["SubCompetitions"])
         # print(competition)
@@ -137,6 +344,8 @@ class MetrixAPI:
                                            date=datetime.datetime.strptime(data['Date'], '%Y-%m-%d'))
         if data.get("CourseID"):
             competition.course = self.get_course(int(data['CourseID']), name=data['CourseName'])
+        competition.tracks = []
+        competition.results = []
         for track in data['Tracks']:
             competition.tracks.append(Track(number=int(track['Number']), par=int(track['Par']),
                                             number_alt=track['NumberAlt']))
@@ -146,26 +355,28 @@ class MetrixAPI:
                                                                                                 None)
         competition.rating_per_stroke = self.cache['ratings_info'].get(competition.id, {}).get('rating_per_stroke',
                                                                                                None)
+        competition.rating_fingerprint = self.cache['ratings_info'].get(competition.id, {}).get('rating_fingerprint',
+                                                                                                None)
 
         for result in data['Results']:
             try:
-                hash_id = hash(result['Name'].upper())
-                if self.has_player(hash_id) and result['UserID'] is not None:
-                    self.players[int(result['UserID'])] = self.get_player(hash_id)
+                player, created = self.players.resolve(int(result['UserID']) if result['UserID'] else None,
+                                                       result['Name'])
+                if created:
+                    self.cache['players'].append(player)
+                    self.mark_player_changed(player)
 
                 comp_result = CompetitionResult(
-                    player=self.get_player(int(result['UserID'] or hash(result['Name'].upper())), name=result['Name']),
+                    player=player,
                     competition=competition,
                     class_name=result['ClassName'],
                     order_number=int(result['OrderNumber'] or 0),
                     submitted_sum=int(result['Sum']),
                     submitted_diff=int(result['Diff']),
-                    rating=self.cache['ratings'].get(competition.id, {}).get(
-                        int(result['UserID'] or hash(result['Name'].upper())), None)
+                    rating=self.cache['ratings'].get(competition.id, {}).get(player.id, None)
                 )
                 comp_result.playoff_result = self.cache['playoffs'].get(competition.id, {}).get(comp_result.player.id, 0)
                 
-                self.players[hash_id] = comp_result.player
                 round_missing = False
 
                 if result.get('DNF') not in (None, "0"):
@@ -233,7 +444,9 @@ class MetrixAPI:
 
     def get_player(self, id, **params) -> Player:
         if id not in self.players:
-            self.players[id] = Player(id=id, **params)
+            self.players.add(Player(id=id, **params))
+            self.cache['players'].append(self.players[id])
+            self.mark_player_changed(self.players[id])
         return self.players[id]
 
     def has_player(self, id) -> bool:
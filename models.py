@@ -4,10 +4,13 @@ __author__ = "Jakub Wroniecki"
 __copyright__ = "Copyright 2022, Jakub Wroniecki, see LICENSE.txt for details."
 
 import datetime
-from typing import Dict, List, Tuple, Optional, Generator, Callable, Type, TypeVar, Any
+from typing import Dict, List, Tuple, Optional, Generator, Callable, Type, TypeVar, Any, Iterable, Iterator
+from array import array
 import itertools
 from dataclasses import dataclass, field, asdict
 
+from utils import rank
+
 
 @dataclass
 class Player:
@@ -32,12 +35,89 @@ class Course:
     name: str
 
 
-@dataclass
+@dataclass(slots=True)
 class Score:
     result: int
     diff: int
 
 
+class Scores:
+    """Per-hole scores of a round, kept as two compact int16 arrays (results and diffs).
+
+    Behaves like a list of Score objects - they are created on access. Sums are cached until the next
+    append/extend, so the arrays should not be modified directly.
+    """
+    __slots__ = ('results', 'diffs', '_result_sum', '_diff_sum')
+
+    def __init__(self, scores: Iterable[Score] = ()):
+        self.results = array('h')
+        self.diffs = array('h')
+        self._result_sum = None
+        self._diff_sum = None
+        self.extend(scores)
+
+    @classmethod
+    def concat(cls, scores: Iterable['Scores']) -> 'Scores':
+        joined = cls()
+        for s in scores:
+            joined.extend(s)
+        return joined
+
+    @property
+    def result_sum(self) -> int:
+        if self._result_sum is None:
+            self._result_sum = sum(self.results)
+        return self._result_sum
+
+    @property
+    def diff_sum(self) -> int:
+        if self._diff_sum is None:
+            self._diff_sum = sum(self.diffs)
+        return self._diff_sum
+
+    def append(self, score: Score):
+        self.results.append(score.result)
+        self.diffs.append(score.diff)
+        self._result_sum = None
+        self._diff_sum = None
+
+    def extend(self, scores: Iterable[Score]):
+        if isinstance(scores, Scores):
+            self.results.extend(scores.results)
+            self.diffs.extend(scores.diffs)
+            self._result_sum = None
+            self._diff_sum = None
+        else:
+            for score in scores:
+                self.append(score)
+
+    def __iadd__(self, scores: Iterable[Score]) -> 'Scores':
+        self.extend(scores)
+        return self
+
+    def __len__(self):
+        return len(self.results)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            sliced = Scores()
+            sliced.results.extend(self.results[idx])
+            sliced.diffs.extend(self.diffs[idx])
+            return sliced
+        return Score(result=self.results[idx], diff=self.diffs[idx])
+
+    def __iter__(self) -> Iterator[Score]:
+        return map(Score, self.results, self.diffs)
+
+    def __eq__(self, other):
+        if isinstance(other, Scores):
+            return self.results == other.results and self.diffs == other.diffs
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return f"Scores({list(self)!r})"
+
+
 @dataclass
 class RankingEntry:
     player: Player
@@ -46,7 +126,7 @@ class RankingEntry:
     sum_tuple: Tuple[int, int] 
     diff: int
     points: int = 0
-    scores: List[Score] = field(default_factory=list)
+    scores: Scores = field(default_factory=Scores)
     comment: str = None
     selected: bool = False
     place: int = 0
@@ -55,11 +135,11 @@ class RankingEntry:
     
     @property
     def calculated_sum(self):
-        return sum(s.result for s in self.scores)
+        return self.scores.result_sum
 
     @property
     def calculated_diff(self):
-        return sum(s.diff for s in self.scores)
+        return self.scores.diff_sum
 
 
 @dataclass
@@ -73,7 +153,7 @@ class CompetitionResult:
     player: Player
     competition: 'Competition'
     class_name: str
-    scores: List[Score] = field(default_factory=list)
+    scores: Scores = field(default_factory=Scores)
     order_number: int = None
     submitted_sum: int = None
     submitted_diff: int = None
@@ -85,11 +165,11 @@ class CompetitionResult:
 
     @property
     def sum(self):
-        return sum(s.result for s in self.scores)
+        return self.scores.result_sum
 
     @property
     def diff(self):
-        return sum(s.diff for s in self.scores)
+        return self.scores.diff_sum
 
     @property
     def rating_or_zero(self):
@@ -125,15 +205,45 @@ class Competition:
     rating_par: int = None
     rating_propagators: int = 0
     rating_per_stroke: float = 0
+    # inputs of the rating calculation (rating.round_fingerprint), rounds are rerated when they change
+    rating_fingerprint: str = None
 
     use_default_category: bool = False
 
+    _par: Tuple[List[Track], int, int] = field(default=None, init=False, repr=False, compare=False)
+
     @property
     def par(self):
-        return sum(tr.par for tr in self.tracks)
+        # cached as (tracks list, its length, par) - recomputed when tracks are replaced or appended
+        if self._par is None or self._par[0] is not self.tracks or self._par[1] != len(self.tracks):
+            self._par = (self.tracks, len(self.tracks), sum(tr.par for tr in self.tracks))
+        return self._par[2]
+
+    _ranking: Dict[bool, Tuple[tuple, List[Tuple[str, RankingList]]]] = field(default_factory=dict, init=False,
+                                                                               repr=False, compare=False)
 
     @property
     def ranking(self) -> List[Tuple[str, RankingList]]:
+        """Ranking per class, computed once for each category mode (`use_default_category`).
+
+        Recomputed when the results lists of the competition rounds are replaced or extended; in-place changes
+        of results (e.g. playoffs) require `invalidate_ranking()`.
+        """
+        rounds = self.sub if len(self.sub) > 0 else [self]
+        key = tuple((r.results, len(r.results)) for r in rounds)
+        cached = self._ranking.get(self.use_default_category)
+        if cached is None or len(cached[0]) != len(key) \
+                or any(a[0] is not b[0] or a[1] != b[1] for a, b in zip(cached[0], key)):
+            cached = (key, list(self.build_ranking()))
+            self._ranking[self.use_default_category] = cached
+        return cached[1]
+
+    def invalidate_ranking(self):
+        self._ranking = {}
+        if self.parent is not None:
+            self.parent.invalidate_ranking()
+
+    def build_ranking(self) -> Generator[Tuple[str, RankingList], None, None]:
         if len(self.sub) > 0:
             results = itertools.chain(*(s.results for s in self.sub))
         else:
@@ -165,7 +275,7 @@ class Competition:
                                      sum_tuple=(sum(r.sum for r in player_results), playoff_results.get(player.id, 0)),
                                      sum=sum(r.sum for r in player_results),
                                      diff=sum(r.submitted_diff for r in player_results),
-                                     scores=list(itertools.chain(*(r.scores for r in player_results)))
+                                     scores=Scores.concat(r.scores for r in player_results)
                                      )
                 for pr in player_results:
                     if pr.dnf==1:
@@ -182,18 +292,18 @@ class Competition:
                 
                 entries.append(entry)
 
-            entries = list(sorted(entries, key=lambda e: e.sum_tuple if not e.dqf else (1e12, 1e12)))
+            order, _ = rank([e.sum_tuple if not e.dqf else (1e12, 1e12) for e in entries])
+            # DQF entries are listed last, but placed by their real sums: a DQF entry takes a new place only
+            # if its sum is higher than all sums before it, otherwise it shares the current one
             place = 1
-            count = 1
-            previous_sum = entries[0].sum_tuple
-            for e in entries:
-
+            previous_sum = entries[order[0]].sum_tuple
+            for count, idx in enumerate(order.tolist(), start=1):
+                e = entries[idx]
                 if e.sum_tuple > previous_sum:
                     place = count
                     previous_sum = e.sum_tuple
                 e.place = place
                 rl.entries.append((place, e))
-                count = count + 1
 
             #print("Yielding class", class_name, "with", len(rl.entries), "entries")
             yield class_name, rl
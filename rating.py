@@ -1,7 +1,10 @@
-from typing import List, Dict
-from scipy import stats
-from matplotlib import pylab
-from metrix import MetrixAPI
+from typing import List, Dict, Tuple, Optional, Iterable
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+import hashlib
+import itertools
+import numpy as np
+from metrix import MetrixAPI, RecordingHandler
 from models import CompetitionResult, Competition
 import logging
 import math
@@ -17,14 +20,53 @@ __author__ = "Bartosz Wilczynski"
 __copyright__ = "Copyright 2024-25, Bartosz Wilczynski, see LICENSE.txt for details."
 
 
-def calculate_round_rating(competition: Competition, player_lookup: Dict[int, int], plotting=False,
-                           outlier_fraction=0.25, prop_min_rating=MIN_RATING):
+def linear_fit(x: np.ndarray, y: np.ndarray) -> Tuple[float, float, float]:
+    """Least squares fit y = intercept + slope * x, returns (slope, intercept, r-value).
+
+    Same arithmetic as `scipy.stats.linregress`, so the results are identical.
+    """
+    ssxm, ssxym, _, ssym = np.cov(x, y, bias=True).flat
+    slope = ssxym / ssxm
+    intercept = np.mean(y) - slope * np.mean(x)
+    return slope, intercept, ssxym / np.sqrt(ssxm * ssym)
+
+
+@dataclass
+class RoundFit:
+    """Fit of propagator scores to their PDGA ratings, score = intercept + slope * rating - the first
+    approximation and the robust one, without outliers."""
+    par: int
+    propagators: int
+    slope: float
+    intercept: float
+    robust_slope: float
+    robust_intercept: float
+    ratings: np.ndarray
+    scores: np.ndarray
+    robust_ratings: np.ndarray
+    robust_scores: np.ndarray
+
+    def approx_rating(self, score: int) -> int:
+        return int(score / self.slope - self.intercept / self.slope)
+
+    def rating(self, score: int) -> int:
+        return int(score / self.robust_slope - self.robust_intercept / self.robust_slope)
+
+    @property
+    def rating_par(self) -> int:
+        return self.rating(self.par)
+
+    @property
+    def rating_per_stroke(self) -> float:
+        return -1 / self.robust_slope
+
+
+def propagators(competition: Competition, player_lookup: Dict[int, int], prop_min_rating=MIN_RATING) \
+        -> Tuple[np.ndarray, np.ndarray]:
+    """PDGA ratings and scores of the round's propagators."""
     scores = []
     ratings = []
-    logging.info(f"Processing round {competition.name} #{competition.id} par {competition.par}")
-
     par = competition.par
-    propagators_count = 0
     for result in competition.results:
         if result.valid and result.player.id in player_lookup:
             pl_rating = player_lookup[result.player.id]
@@ -34,52 +76,88 @@ def calculate_round_rating(competition: Competition, player_lookup: Dict[int, in
                 #print("adding",pl_score,pl_rating)
                 scores.append(pl_score)
                 ratings.append(pl_rating)
-                propagators_count += 1
+    return np.array(ratings), np.array(scores)
 
-    logging.info(f"Available propagators {propagators_count} of {len(competition.results)}")
+
+def round_fingerprint(competition: Competition, player_lookup: Dict[int, int], outlier_fraction=0.25,
+                      prop_min_rating=MIN_RATING) -> str:
+    """Hash of everything the round's ratings are calculated from - the settings, par, results and PDGA ratings of
+    the players (which determine the propagators)."""
+    digest = hashlib.sha1(repr((competition.par, outlier_fraction, prop_min_rating)).encode('utf-8'))
+    for result in competition.results:
+        digest.update(repr((result.player.id, result.valid, result.diff,
+                            player_lookup.get(result.player.id))).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def fit_round(name: str, id: int, par: int, ratings: np.ndarray, scores: np.ndarray, result_count: int,
+              outlier_fraction=0.25) -> Optional[RoundFit]:
+    """Robust fit of a round, None if there are too few propagators."""
+    propagators_count = len(ratings)
+    logging.info(f"Available propagators {propagators_count} of {result_count}")
     if propagators_count < MIN_PROPAGATORS:
-        logging.warning(f"Too few propagators for {competition.name} #{competition.id} - skipping.")
+        logging.warning(f"Too few propagators for {name} #{id} - skipping.")
         return None
 
     # first approx fit
-    lr = stats.linregress(ratings, scores)
-    predictions = [(lr.intercept + lr.slope * rating) for rating in ratings]
-    residuals = [(prediction - score) ** 2 for (prediction, score) in zip(predictions, scores)]
-    rating_calc = lambda x: int(x / lr.slope - lr.intercept / lr.slope)
+    slope, intercept, rvalue = linear_fit(ratings, scores)
+    predictions = intercept + slope * ratings
+    residuals = (predictions - scores) ** 2
+    rating_calc = lambda x: int(x / slope - intercept / slope)
     logging.info(
-        f"Round par score {rating_calc(par)} diff per stroke {-1 / lr.slope} r-val {lr.rvalue}  max. resid. {math.sqrt(max(residuals))}")
+        f"Round par score {rating_calc(par)} diff per stroke {-1 / slope} r-val {rvalue}  max. resid. {math.sqrt(residuals.max())}")
 
     while True:
         # compute the outliers
         num_outliers = int(outlier_fraction * len(residuals))
-        outlier_thr = sorted(residuals)[-num_outliers]
+        outlier_thr = np.partition(residuals, -num_outliers)[-num_outliers]
         logging.info(f"number of outliers {num_outliers}")
-        #print("reszty",residuals,"res_thr",outlier_thr)
-        new_rats, new_scs = [], []
-        for r, s, p, rs in zip(ratings, scores, predictions, residuals):
-            if rs >= outlier_thr:
-                logging.debug(f"outlier {r} {s} {p} {rs}")
-            else:
-                new_rats.append(r)
-                new_scs.append(s)
-        #print([x for x in zip(new_rats,new_scs)])
+        # residuals of the last fit are matched with the leading propagators of the first fit
+        count = len(residuals)
+        outliers = residuals >= outlier_thr
+        for r, s, p, rs in zip(ratings[:count][outliers], scores[:count][outliers], predictions[:count][outliers],
+                               residuals[outliers]):
+            logging.debug(f"outlier {r} {s} {p} {rs}")
+        new_rats, new_scs = ratings[:count][~outliers], scores[:count][~outliers]
         # second - improved fit
-        lr_new = stats.linregress(new_rats, new_scs)
-        new_preds = [(lr_new.intercept + lr_new.slope * rating) for rating in new_rats]
-        residuals = [(prediction - score) ** 2 for (prediction, score) in zip(new_preds, new_scs)]
-        rating_calc_new = lambda x: int(x / lr_new.slope - lr_new.intercept / lr_new.slope)
+        slope_new, intercept_new, rvalue_new = linear_fit(new_rats, new_scs)
+        residuals = (intercept_new + slope_new * new_rats - new_scs) ** 2
+        rating_calc_new = lambda x: int(x / slope_new - intercept_new / slope_new)
 
         logging.info(
-            f"Robust round par score {rating_calc_new(par)} diff per stroke {-1 / lr_new.slope} r-val {lr_new.rvalue} max. resid. {math.sqrt(max(residuals))}")
-        if len(residuals) < MIN_PROPAGATORS or  math.sqrt(max(residuals)) < MAX_RESIDUALS:
+            f"Robust round par score {rating_calc_new(par)} diff per stroke {-1 / slope_new} r-val {rvalue_new} max. resid. {math.sqrt(residuals.max())}")
+        if len(residuals) < MIN_PROPAGATORS or  math.sqrt(residuals.max()) < MAX_RESIDUALS:
             #print("breaking",math.sqrt(max(residuals)),len(residuals))
             break
-        
-    competition.rating_par = rating_calc_new(par)
-    competition.rating_propagators = propagators_count
-    competition.rating_per_stroke = -1 / lr_new.slope
+
+    return RoundFit(par=par, propagators=propagators_count, slope=slope, intercept=intercept,
+                    robust_slope=slope_new, robust_intercept=intercept_new, ratings=ratings, scores=scores,
+                    robust_ratings=new_rats, robust_scores=new_scs)
+
+
+def fit_round_recorded(name: str, id: int, par: int, ratings: np.ndarray, scores: np.ndarray, result_count: int,
+                       outlier_fraction: float, log_level: int) -> Tuple[Optional[RoundFit], List[logging.LogRecord]]:
+    """`fit_round` in a worker process, returns the fit and the log records to replay in the main process."""
+    logger = logging.getLogger()
+    logger.setLevel(log_level)
+    recording = RecordingHandler()
+    # handlers inherited from the main process would log the records twice
+    logger.handlers = [recording]
+    try:
+        fit = fit_round(name, id, par, ratings, scores, result_count, outlier_fraction)
+    finally:
+        logger.removeHandler(recording)
+    return fit, recording.records
+
+
+def apply_fit(competition: Competition, fit: RoundFit, player_lookup: Dict[int, int]):
+    """Write the round rating and the players' ratings."""
+    competition.rating_par = fit.rating_par
+    competition.rating_propagators = fit.propagators
+    competition.rating_per_stroke = fit.rating_per_stroke
 
     # apply the robust ranking to the players' results
+    par = fit.par
     for result in competition.results:
         pl_score = par + result.diff
         if result.player.id in player_lookup:
@@ -90,7 +168,7 @@ def calculate_round_rating(competition: Competition, player_lookup: Dict[int, in
         if pl_score >=DNF_SCORE:
             result.rating = None
         else:
-            rating_new_val = rating_calc_new(pl_score)
+            rating_new_val = fit.rating(pl_score)
             #print(rating_new_val)
             if rating_new_val <= MIN_RATING:
                 result.rating = None
@@ -98,40 +176,145 @@ def calculate_round_rating(competition: Competition, player_lookup: Dict[int, in
                 result.rating = rating_new_val
 
         logging.debug(f"{result.player.name} rating  {pl_rating} diff {result.diff} par {par} score {pl_score} "
-                      f"round rating {rating_calc(pl_score)} robust rating {result.rating}")
+                      f"round rating {fit.approx_rating(pl_score)} robust rating {result.rating}")
 
-    if plotting:
-        # full fit plots
+
+def plot_name(competition: Competition) -> str:
+    if  competition.parent is None:
+        return f"round-{competition.id}"
+    return f"round-{competition.parent.id}-{competition.id}"
+
+
+def plot_digest(title: str, fit: RoundFit) -> str:
+    """Hash of the plotted data, stored in the PNG files."""
+    digest = hashlib.sha1(title.encode('utf-8'))
+    for values in (fit.ratings, fit.scores, fit.robust_ratings, fit.robust_scores):
+        digest.update(np.asarray(values, dtype=np.float64).tobytes())
+    digest.update(repr([float(v) for v in (fit.par, fit.slope, fit.intercept, fit.robust_slope,
+                                           fit.robust_intercept)]).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def png_comment(filename: str) -> Optional[str]:
+    """The 'Comment' text chunk of a PNG file, None if the file or the chunk does not exist."""
+    try:
+        with open(filename, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    pos = 8
+    while pos + 8 <= len(data):
+        length = int.from_bytes(data[pos:pos + 4], 'big')
+        if data[pos + 4:pos + 8] == b'tEXt':
+            key, _, value = data[pos + 8:pos + 8 + length].partition(b'\0')
+            if key == b'Comment':
+                return value.decode('latin-1')
+        pos += 12 + length
+    return None
+
+
+def plot_fit(name: str, title: str, fit: RoundFit, digest: str):
+    """Save the plots of the first and the robust fit of a round - `<name>.png` and `<name>-robust.png`."""
+    # matplotlib takes a long time to import, only load it when plotting
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    rating_calc, rating_calc_new = fit.approx_rating, fit.rating
+    ratings, scores, new_rats, new_scs = fit.ratings, fit.scores, fit.robust_ratings, fit.robust_scores
+    par = fit.par
+
+    # full fit plots
+    figure = Figure()
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot()
+    axes.plot(ratings, scores, "k.", label="fitted scores")
+    axes.plot([rating_calc(max(scores) + 2), rating_calc(min(scores) - 2)], [max(scores) + 2, min(scores) - 2],
+              "b-", label="fitted trend")
+    axes.plot([rating_calc(par)], [par], "ro", label="par rating=%d (+/-%d)" % (rating_calc(par), -1 / fit.slope))
+    axes.legend()
+    axes.set_title(f"{title}", fontsize=10)
+    figure.savefig(f"{name}.png", metadata={'Comment': digest})
+
+    # robust fit plots
+    figure = Figure()
+    FigureCanvasAgg(figure)
+    axes = figure.add_subplot()
+    axes.plot(new_rats, new_scs, "k.", label="robust fitted scores")
+    axes.plot([rating_calc_new(max(new_scs) + 1), rating_calc_new(min(new_scs) - 1)],
+              [max(new_scs) + 1, min(new_scs) - 1], "b-", label="fitted trend")
+    axes.plot([rating_calc_new(par)], [par], "ro",
+              label="par rating=%d (+/-%d)" % (rating_calc_new(par), fit.rating_per_stroke))
+    axes.legend()
+    axes.set_title(f"{title} (robust)", fontsize=10)
+    figure.savefig(f"{name}-robust.png", metadata={'Comment': digest})
+
+
+def plot_rounds(plots: Iterable[Tuple[Competition, Optional[RoundFit]]], max_workers: Optional[int] = None):
+    """Plot the fits of rated rounds, in `max_workers` processes. Plots whose data did not change since they were
+    saved are skipped."""
+    jobs = []
+    for competition, fit in plots:
+        if fit is None:
+            continue
+        name = plot_name(competition)
         title = " ".join(competition.name.split("&rarr;")[-2:])
-        pylab.figure()
-        pylab.plot(ratings, scores, "k.", label="fitted scores")
-        pylab.plot([rating_calc(max(scores) + 2), rating_calc(min(scores) - 2)], [max(scores) + 2, min(scores) - 2],
-                   "b-", label="fitted trend")
-        pylab.plot([rating_calc(par)], [par], "ro", label="par rating=%d (+/-%d)" % (rating_calc(par), -1 / lr.slope))
-        pylab.legend()
-        pylab.title(f"{title}", fontsize=10)
-        if  competition.parent is None:
-            pylab.savefig(f"round-{competition.id}.png")
-        else:
-            pylab.savefig(f"round-{competition.parent.id}-{competition.id}.png")
-        pylab.close()
-
-        # robust fit plots
-        pylab.figure()
-        pylab.plot(new_rats, new_scs, "k.", label="robust fitted scores")
-        #print("robust ratings and scores",new_rats,new_scs)
-        pylab.plot([rating_calc_new(max(new_scs) + 1), rating_calc_new(min(new_scs) - 1)],
-                   [max(new_scs) + 1, min(new_scs) - 1], "b-", label="fitted trend")
-        pylab.plot([rating_calc_new(par)], [par], "ro",
-                   label="par rating=%d (+/-%d)" % (rating_calc_new(par), -1 / lr_new.slope))
-        pylab.legend()
-        pylab.title(f"{title} (robust)", fontsize=10)
-        if  competition.parent is None:
-            pylab.savefig(f"round-{competition.id}-robust.png")
+        digest = plot_digest(title, fit)
+        if png_comment(f"{name}.png") == digest and png_comment(f"{name}-robust.png") == digest:
+            logging.debug(f"Plots of {competition.name} #{competition.id} are up to date.")
+            continue
+        jobs.append((name, title, fit, digest))
+
+    logging.info(f"Plotting {len(jobs)} rounds.")
+    if max_workers == 1 or len(jobs) <= 1:
+        for job in jobs:
+            plot_fit(*job)
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(plot_fit, *zip(*jobs)))
+
+
+def rate_rounds(rounds: Iterable[Competition], player_lookup: Dict[int, int], outlier_fraction=0.25,
+                prop_min_rating=MIN_RATING, max_workers: Optional[int] = None,
+                api: Optional[MetrixAPI] = None) -> List[Optional[RoundFit]]:
+    """Rate the rounds - fit all of them first (in `max_workers` processes, if more than one), then write back
+    the round and players' ratings and mark them changed in `api` (saved by the next `save_cache`). Returns the
+    fits (for `plot_rounds`), None for rounds with too few propagators."""
+    rounds = list(rounds)
+    packed = [(c.name, c.id, c.par, *propagators(c, player_lookup, prop_min_rating), len(c.results), outlier_fraction)
+              for c in rounds]
+    recorded = None
+    if max_workers is not None and max_workers > 1 and len(rounds) > 1:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            recorded = list(executor.map(fit_round_recorded, *zip(*packed),
+                                         itertools.repeat(logging.getLogger().level)))
+
+    fits = []
+    for i, competition in enumerate(rounds):
+        logging.info(f"Processing round {competition.name} #{competition.id} par {competition.par}")
+        if recorded is None:
+            fit = fit_round(*packed[i])
         else:
-            pylab.savefig(f"round-{competition.parent.id}-{competition.id}-robust.png")
+            fit, records = recorded[i]
+            for record in records:
+                logging.getLogger().handle(record)
+        if fit is not None:
+            apply_fit(competition, fit, player_lookup)
+            competition.rating_fingerprint = round_fingerprint(competition, player_lookup, outlier_fraction,
+                                                               prop_min_rating)
+        if api is not None:
+            api.mark_ratings_changed(competition)
+        fits.append(fit)
+    return fits
+
 
-        pylab.close()
+def calculate_round_rating(competition: Competition, player_lookup: Dict[int, int], plotting=False,
+                           outlier_fraction=0.25, prop_min_rating=MIN_RATING,
+                           api: Optional[MetrixAPI] = None) -> Optional[RoundFit]:
+    fit = rate_rounds([competition], player_lookup, outlier_fraction=outlier_fraction,
+                      prop_min_rating=prop_min_rating, api=api)[0]
+    if plotting:
+        plot_rounds([(competition, fit)], max_workers=1)
+    return fit
 
 # if __name__ == "__main__":
 #     import os
@@ -0,0 +1,79 @@
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+import pytest
+
+from metrix import MetrixAPI
+
+"""Startup cost of the command line tool - heavy packages are imported only when they are used."""
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# import time of a `main.py --skip-ratings` run of a small league, in seconds (measured about 0.32 s)
+IMPORT_BUDGET = 0.5
+# imported only when rounds are rated or plotted, or pages rendered; numpy is not listed - the standings are scored
+# with it, so every run imports it (and it counts to the budget)
+HEAVY = ('matplotlib', 'scipy', 'jinja2')
+RATING = ('rating', 'matplotlib', 'scipy')
+
+LEAGUE_CONFIG = """leagues:
+  TEST:
+    title: Test
+    competition_ids: [1000, 2000]
+    categories: {OPEN, WOMEN}
+    scoring: proportional
+"""
+
+
+def import_times(args: List[str], cwd=ROOT) -> Dict[str, int]:
+    """Modules imported by `python <args>` -> their own import time in microseconds."""
+    process = subprocess.run([sys.executable, '-X', 'importtime', *args], cwd=cwd, capture_output=True, text=True,
+                             check=True)
+    times = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, _, name = line[len('import time:'):].split('|')
+        times[name.strip()] = int(own)
+    return times
+
+
+@pytest.fixture
+def league(tmp_path):
+    """Config and cache of a league with a single round and a two round competition, no downloads needed."""
+    with open(os.path.join(ROOT, 'tests', 'data', 'metrix_replies.json'), encoding='utf-8') as f:
+        replies = json.load(f)
+    api = MetrixAPI(cache_file=str(tmp_path / 'results.cache.pkl'))
+    for competition_id, reply in replies.items():
+        api.cache['competitions'][int(competition_id)] = reply
+        api.cache['fetch_info'][int(competition_id)] = {'fetched_at': time.time()}
+    api.save_cache(full=True)
+    (tmp_path / 'config.yaml').write_text(LEAGUE_CONFIG, encoding='utf-8')
+    return tmp_path
+
+
+def skip_ratings_run(league) -> Dict[str, int]:
+    times = import_times([os.path.join(ROOT, 'main.py'), '-l', 'TEST', '-c', 'config.yaml', '--cache-file',
+                          'results.cache.pkl', '--skip-ratings', '-q'], cwd=league)
+    assert (league / 'TEST.ranking.html').exists()
+    return times
+
+
+@pytest.mark.parametrize('module', ['main', 'rating'])
+def test_no_heavy_imports(module):
+    imported = import_times(['-c', f'import {module}'])
+    assert [name for name in imported if name.split('.')[0] in HEAVY] == []
+
+
+def test_skip_ratings_does_not_import_rating(league):
+    imported = skip_ratings_run(league)
+    assert [name for name in imported if name.split('.')[0] in RATING] == []
+
+
+def test_import_budget(league):
+    total = sum(skip_ratings_run(league).values()) / 1e6
+    assert total < IMPORT_BUDGET, f"imports of main.py --skip-ratings took {total:.3f} s"
@@ -0,0 +1,112 @@
+import http.server
+import json
+import os
+import threading
+import time
+import urllib.parse
+from collections import Counter
+
+import pytest
+import requests
+
+from metrix import MetrixAPI
+
+"""MetrixAPI.prefetch against a local stub of the Metrix API serving recorded replies."""
+
+with open(os.path.join(os.path.dirname(__file__), 'data', 'metrix_replies.json'), encoding='utf-8') as f:
+    REPLIES = json.load(f)
+
+
+class StubServer(http.server.ThreadingHTTPServer):
+    """Serves `?content=result&id=<id>` from REPLIES. IDs in `errors` are answered with the listed status codes (one
+    per request) first; every request waits `delay` seconds, so concurrent requests overlap."""
+
+    daemon_threads = True
+
+    def __init__(self, delay=0.1):
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.delay = delay
+        self.errors = {}
+        self.requests = Counter()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    @property
+    def api_url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/api.php'
+
+
+class StubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server: StubServer = self.server
+        competition_id = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)['id'][0]
+        with server.lock:
+            server.requests[int(competition_id)] += 1
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            errors = server.errors.get(int(competition_id))
+            status = errors.pop(0) if errors else 200 if competition_id in REPLIES else 404
+        time.sleep(server.delay)
+        body = json.dumps(REPLIES[competition_id]).encode('utf-8') if status == 200 else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        with server.lock:
+            server.in_flight -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = StubServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_prefetch(server):
+    api = MetrixAPI(api_url=server.api_url, max_workers=4)
+    fetched = api.prefetch([1000, 2000])
+    # the competitions first, then the sub events listed in `Events` of the fetched replies
+    assert set(fetched) == {1000, 2000, 2001, 2002}
+    assert server.requests == {1000: 1, 2000: 1, 2001: 1, 2002: 1}
+    assert server.max_in_flight == 2
+    assert {competition_id: api.cache['competitions'][competition_id] for competition_id in fetched} == \
+           {int(competition_id): reply for competition_id, reply in REPLIES.items()}
+
+    # parsed from the cache, nothing fetched again
+    competition = api.results(2000)
+    assert [sub.id for sub in competition.sub] == [2001, 2002]
+    assert [len(sub.results) for sub in competition.sub] == [8, 8]
+    assert api.prefetch([1000, 2000]) == {}
+    assert sum(server.requests.values()) == 4
+
+
+def test_prefetch_retries(server):
+    server.errors = {2001: [503]}
+    api = MetrixAPI(api_url=server.api_url, retries=1, backoff=0)
+    assert set(api.prefetch([2000])) == {2000, 2001, 2002}
+    assert server.requests[2001] == 2
+
+
+@pytest.mark.parametrize('competition_id, status', [(2002, 404), (1000, 500)])
+def test_prefetch_error(server, competition_id, status):
+    server.errors = {competition_id: [status]}
+    api = MetrixAPI(api_url=server.api_url, retries=0)
+    with pytest.raises(requests.RequestException):
+        api.prefetch([1000, 2000])
+    # a failed prefetch leaves the cache unchanged
+    assert api.cache['competitions'] == {}
+    assert api._changes['competitions'] == set()
+
+    server.errors = {}
+    assert set(api.prefetch([1000, 2000])) == {1000, 2000, 2001, 2002}
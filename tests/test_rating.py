@@ -0,0 +1,60 @@
+import json
+import os
+
+import pytest
+
+import rating
+from metrix import MetrixAPI
+from models import Competition, CompetitionResult, Player, Score, Scores, Track
+
+"""Round ratings compared with ratings recorded from the previous (scipy.stats.linregress) implementation."""
+
+with open(os.path.join(os.path.dirname(__file__), 'data', 'rating_rounds.json'), encoding='utf-8') as f:
+    ROUNDS = json.load(f)
+
+
+def make_round(recorded: dict) -> Competition:
+    """Round of par 3 holes; the score of a player is recorded as a single diff (the rating only uses its sum)."""
+    tracks = [Track(number=n, par=3) for n in range(1, recorded['holes'] + 1)]
+    competition = Competition(id=recorded['id'], name=f"League &rarr; Event &rarr; Round {recorded['id']}",
+                              tracks=tracks)
+    for player_id, diff, valid in recorded['results']:
+        competition.results.append(CompetitionResult(player=Player(id=player_id, name=f"Player {player_id}"),
+                                                     competition=competition, class_name='OPEN', valid=valid,
+                                                     scores=Scores([Score(result=3 + diff, diff=diff)])))
+    return competition
+
+
+def player_lookup(recorded: dict) -> dict:
+    return {int(player_id): pdga_rating for player_id, pdga_rating in recorded['player_ratings'].items()}
+
+
+def assert_recorded(competition: Competition, expected: dict):
+    assert competition.rating_par == expected['rating_par']
+    assert competition.rating_propagators == expected['rating_propagators']
+    if expected['rating_per_stroke'] is not None:
+        assert float(competition.rating_per_stroke) == expected['rating_per_stroke']
+    assert [r.rating for r in competition.results] == expected['ratings']
+
+
+@pytest.mark.parametrize('recorded', ROUNDS, ids=[str(r['id']) for r in ROUNDS])
+def test_calculate_round_rating(recorded):
+    competition = make_round(recorded)
+    rating.calculate_round_rating(competition, player_lookup(recorded), outlier_fraction=0.25, prop_min_rating=500)
+    assert_recorded(competition, recorded['expected'])
+
+
+@pytest.mark.parametrize('max_workers', [None, 2])
+def test_rate_rounds(max_workers):
+    competitions = [make_round(recorded) for recorded in ROUNDS]
+    lookup = {}
+    for recorded in ROUNDS:
+        lookup.update(player_lookup(recorded))
+    api = MetrixAPI()
+    fits = rating.rate_rounds(competitions, lookup, outlier_fraction=0.25, prop_min_rating=500,
+                              max_workers=max_workers, api=api)
+    for competition, fit, recorded in zip(competitions, fits, ROUNDS):
+        assert (fit is None) == (recorded['expected']['rating_par'] is None)
+        assert_recorded(competition, recorded['expected'])
+    # saved by the next save_cache
+    assert api._changed_ratings == {competition.id: competition for competition in competitions}
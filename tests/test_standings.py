@@ -0,0 +1,133 @@
+import random
+from typing import List
+
+import pytest
+
+from dgw import ZimowyDGW
+from models import Competition, CompetitionResult, Player, Score, Scores, Track
+
+"""Season standings updated repeatedly (ZimowyDGW.update_standings) compared with standings built from scratch."""
+
+CATEGORIES = {'OPEN': None, 'WOMEN': None, 'JUNIOR': None}
+SCORING_TABLES = {'dgpt100': {'type': 'fixed', 'points': [100, 85, 75, 69, 64, 60, 57, 54, 52, 50, 48, 46, 44, 42, 40,
+                                                            38, 36, 34, 32, 30]}}
+PLAYERS = [Player(id=100 + i, name=f"Player {i}") for i in range(30)]
+EVENT_IDS = [5000, 5010, 5020, 5030, 5040, 5050]
+# events without juniors - their ranking is carried over from the previous event (a class has to take part in the
+# first event of the league, none of these is first in the tests)
+NO_JUNIOR_IDS = {5020, 5030}
+
+
+def class_name(player: Player) -> str:
+    if player.id % 13 == 0:
+        return 'JUNIOR'  # a class smaller than 3 players, scored by the OPEN places
+    return 'WOMEN' if player.id % 4 == 0 else 'OPEN'
+
+
+def make_event(competition_id: int) -> Competition:
+    """Synthetic event, the same data for the same ID; events with an ID ending in 10 have two rounds."""
+    rnd = random.Random(competition_id)
+    tracks = [Track(number=n, par=3) for n in range(1, 10)]
+    event = Competition(id=competition_id, name=f"Event {competition_id}", tracks=tracks)
+    if competition_id % 20 == 10:
+        event.sub = [Competition(id=competition_id + r, name=f"Round {r}", tracks=tracks, parent=event)
+                     for r in (1, 2)]
+    juniors = [player for player in PLAYERS if class_name(player) == 'JUNIOR']
+    players = rnd.sample([player for player in PLAYERS if player not in juniors], rnd.randint(12, 25))
+    if competition_id not in NO_JUNIOR_IDS:
+        players = juniors + players
+    for round in (event.sub or [event]):
+        for player in players:
+            if len(event.sub) > 0 and rnd.random() < 0.05:
+                continue  # missed a round - DNF
+            diffs = [rnd.choice((-1, 0, 0, 0, 1, 1, 2)) for _ in tracks]
+            round.results.append(CompetitionResult(player=player, competition=round, class_name=class_name(player),
+                                                   scores=Scores(Score(result=3 + d, diff=d) for d in diffs),
+                                                   submitted_sum=sum(3 + d for d in diffs), submitted_diff=sum(diffs),
+                                                   dnf=1 if rnd.random() < 0.05 else 0))
+    return event
+
+
+def make_events(ids: List[int]) -> List[Competition]:
+    return [make_event(competition_id) for competition_id in ids]
+
+
+def make_league(scoring: str, best_of=3) -> ZimowyDGW:
+    return ZimowyDGW([], categories=CATEGORIES, scoring=scoring, scoring_tables=SCORING_TABLES, best_of=best_of)
+
+
+def standings(dgw: ZimowyDGW) -> dict:
+    return {class_name: [(e.player.id, e.sum, e.place,
+                          [(competition_id, r.points, str(r.comment), r.selected) for competition_id, r in
+                           e.results.items()]) for e in entries]
+            for class_name, entries in dgw.entries_sorted.items()}
+
+
+def rebuilt(scoring: str, ids: List[int], playoffs=(), best_of=3) -> dict:
+    events = make_events(ids)
+    for competition_id, player_id in playoffs:
+        set_playoff(events, competition_id, player_id)
+    dgw = make_league(scoring, best_of)
+    dgw.update_standings(events)
+    return standings(dgw)
+
+
+def set_playoff(events: List[Competition], competition_id: int, player_id: int):
+    for event in events:
+        if event.id == competition_id:
+            for round in (event.sub or [event]):
+                for result in round.results:
+                    if result.player.id == player_id:
+                        result.playoff_result = 1
+            event.invalidate_ranking()
+
+
+def tied_player(event: Competition) -> int:
+    """A player sharing a place with the previous one in the event's ranking."""
+    for _, ranking in event.ranking:
+        for (place, _), (next_place, entry) in zip(ranking.entries, ranking.entries[1:]):
+            if place == next_place and not entry.dqf:
+                return entry.player.id
+    raise AssertionError(f"no tie in event {event.id}")
+
+
+@pytest.mark.parametrize('scoring', ['proportional', 'dgpt100'])
+def test_adding_events(scoring):
+    events = make_events(EVENT_IDS)
+    dgw = make_league(scoring)
+    for count in range(1, len(events) + 1):
+        dgw.update_standings(events[:count])
+        assert standings(dgw) == rebuilt(scoring, EVENT_IDS[:count])
+
+
+@pytest.mark.parametrize('scoring', ['proportional', 'dgpt100'])
+def test_playoff_change(scoring):
+    events = make_events(EVENT_IDS)
+    dgw = make_league(scoring)
+    dgw.update_standings(events)
+    player_id = tied_player(events[2])
+    set_playoff(events, EVENT_IDS[2], player_id)
+    dgw.update_standings(events)
+    assert standings(dgw) == rebuilt(scoring, EVENT_IDS, playoffs=[(EVENT_IDS[2], player_id)])
+
+
+@pytest.mark.parametrize('scoring', ['proportional', 'dgpt100'])
+def test_reorder_and_removal(scoring):
+    events = make_events(EVENT_IDS)
+    by_id = {event.id: event for event in events}
+    dgw = make_league(scoring)
+    dgw.update_standings(events)
+    for ids in (EVENT_IDS[:2] + EVENT_IDS[3:], EVENT_IDS[::-1], EVENT_IDS[1:], EVENT_IDS):
+        dgw.update_standings([by_id[competition_id] for competition_id in ids])
+        assert standings(dgw) == rebuilt(scoring, ids)
+
+
+def test_competitions_shared_with_another_league():
+    # leagues on the same MetrixAPI share the competitions and their ranking entries (points, selected results)
+    events = make_events(EVENT_IDS[:3])
+    first = make_league('proportional', best_of=1)
+    first.update_standings(events)
+    other = make_league('dgpt100', best_of=5)
+    other.update_standings(events)
+    first.update_standings(events)
+    assert standings(first) == rebuilt('proportional', EVENT_IDS[:3], best_of=1)
@@ -1,14 +1,43 @@
-from typing import List, Tuple, Callable, Type, TypeVar, Iterable
+from typing import List, Tuple, Callable, Type, TypeVar, Iterable, Optional, Sequence
+import heapq
+
+import numpy as np
+
 REntry = TypeVar('REntry')
 
 
+def select_best(entries: Iterable[REntry], count: Optional[int], key: Callable[[REntry], int]) -> List[REntry]:
+    """The `count` entries with the lowest `key` (all entries if `count` is None), same as
+    `sorted(entries, key=key)[:count]`, without sorting all of them."""
+    if count is None:
+        return sorted(entries, key=key)
+    return heapq.nsmallest(count, entries, key=key)
+
+
+def rank(keys: Sequence) -> Tuple[np.ndarray, np.ndarray]:
+    """Stable ascending order of `keys` and places of the ordered entries, equal keys share a place (1, 2, 2, 4).
+
+    `keys` are numbers, or equal length tuples compared like tuples.
+    """
+    keys = np.asarray(keys)
+    if len(keys) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    if keys.ndim == 1:
+        order = np.argsort(keys, kind='stable')
+        ordered = keys[order]
+        changed = ordered[1:] != ordered[:-1]
+    else:
+        order = np.lexsort(keys.T[::-1])
+        ordered = keys[order]
+        changed = np.any(ordered[1:] != ordered[:-1], axis=1)
+    first = np.concatenate(([True], changed))
+    places = np.maximum.accumulate(np.where(first, np.arange(1, len(keys) + 1), 0))
+    return order, places
+
+
 def enumerate_ranking(ranking_list: Iterable[Type[REntry]], key: Callable[[REntry], int])\
         -> List[Tuple[int, Type[REntry]]]:
-    p = 0
-    c = 0
-    v = -1e21
-    for entry in sorted(ranking_list, key=key):
-        c = c + 1
-        if key(entry) > v:
-            p = c
-        yield p, entry
+    entries = list(ranking_list)
+    order, places = rank([key(entry) for entry in entries])
+    for idx, place in zip(order.tolist(), places.tolist()):
+        yield place, entries[idx]